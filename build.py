@@ -11,36 +11,218 @@ from tkinter import messagebox
 from tkinter import scrolledtext
 from tkinter.simpledialog import askstring
 import webbrowser
-import os, re, html, subprocess, platform
+import os, re, html, subprocess, platform, sys
 import markdown
 import time    
 import shutil
+import hashlib
+import threading
+import queue
+import argparse
+import difflib
+import io
+import tarfile
+import zipfile
+import json
+import sqlite3
+import socket
+import socketserver
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
 # Following needed only if SFTP is used
 #import pysftp # https://pysftp.readthedocs.io/en/release_0.2.9/pysftp.html
 from pathlib import Path
 
 output_display = False
-current_page = None
 DATA_FOLDER = 'data'
 PAGES_FOLDER = '.'
 HOME_PAGE = 'index'
-site_folder = None
 starting_folder = os. getcwd()
-# Code is present to handle SFTP uploads, but it is not enabled (see process_settings()).
-# It was written because an earlier version supported building sites for hosts with servers,
-# but now only serverless hosts are handled.
-sftp = None # always
+# Static assets (images, scripts, etc.) referenced from pages are tracked by content hash
+# in ASSET_MANIFEST, so they're copied and uploaded only when new or changed.
+ASSET_MANIFEST = 'assets.manifest'
+REPORT_FILE = 'build-report.log'
+LINK_REPORT_FILE = 'link-report.log'
+FIXED_FILES = ['masonry.pkgd.min.js', 'imagesloaded.pkgd.min.js']
+# Links between pages, recorded as pages are rendered: page -> (prev, next, [targets]).
+# The reverse index (target -> pages linking to it) is kept alongside it in BACKLINK_INDEX.
+LINK_INDEX = 'links.index'
+BACKLINK_INDEX = 'backlinks.index'
+# The page registry (see PageInfo) is saved in PAGE_INDEX so that opening a site reads
+# only the pages that changed since.
+PAGE_INDEX = 'pages.index'
+MEMORY_BUDGET = 64 * 1024 * 1024 # default for @memory, in bytes
+
+# Everything about one site lives in a Site, so one process can build several sites at
+# once (see build_sites()) without depending on the current directory. The GUI works on
+# the Site in the global site.
+class Site:
+	def __init__(self, folder):
+		self.folder = os.path.abspath(folder)
+		self.pages = {} # tag -> PageInfo, sorted by tag
+		# page text, parsed pages and minified output are cached within memory_budget bytes
+		self.texts = SizedCache() # tag -> text
+		self.parse_cache = SizedCache() # hash of page text -> IR
+		self.minify_cache = SizedCache() # (kind, hash of input) -> output
+		self.memory_budget = MEMORY_BUDGET
+		self.menu_list = []
+		self.macs = ''
+		self.want_prevnext = False
+		self.fingerprint = False
+		self.minify = False
+		self.shared_menu = False
+		self.markdown = DEFAULT_MARKDOWN # name of the engine in MARKDOWN_ENGINES
+		self.site_url = None # for the sitemap, if @siteurl is set
+		self.bytes_saved = 0
+		self.changed = [] # files written in this build, as named by output_name()
+		self.releases = 0 # number of releases to keep, if @releases is set
+		self.out_folder = None
+		self.release_hashes = None # path in release -> hash, while building a release
+		# Code is present to handle SFTP uploads, but it is not enabled (see process_settings()).
+		# It was written because an earlier version supported building sites for hosts with servers,
+		# but now only serverless hosts are handled.
+		self.sftp = None # UploadQueue
+		self.uploaded_assets = {} # path -> (rel, hash) for assets queued for upload
+		self.sftp_host = None
+		self.sftp_username = None
+		self.sftp_password = None
+		self.sftp_path = None
+		self.num_successful = 0
+		self.num_attempted = 0
+		self.asset_manifest = {} # path -> [hash, size, mtime, uploaded hash]
+		self.assets_seen = {} # path -> url to use, for assets already handled in this build
+		self.fingerprints = {} # hash -> fingerprinted url
+		self.missing_assets = {} # url -> set of pages
+		self.build_report = []
+		self.links = {}
+		self.backlinks = {}
+		self.db = None # sqlite3 connection, if data/site.db exists (see open_store())
+		self.db_fts = False
+		self.page_weights = {} # page -> {metric: value}, see record_page_weight()
+		self.budgets = {} # metric -> (limit, fail), from @budget
+		self.budget_failures = []
+
+	def data_path(self, name):
+		return os.path.join(self.folder, DATA_FOLDER, name)
+
+	def pages_path(self, name):
+		return os.path.join(self.folder, PAGES_FOLDER, name)
+
+	# Generated files go to the pages folder, or to the release being built (see begin_release()).
+	def out_path(self, name):
+		return os.path.join(self.out_folder or self.pages_path(''), name)
+
+# Markdown engines that can be chosen with @markdown. Each one returns a function
+# that converts Markdown text to HTML. Engines other than Python-Markdown are only
+# imported when they're used.
+def python_markdown():
+	md = markdown.Markdown()
+	return lambda s: md.reset().convert(s)
+
+def markdown_it_engine():
+	from markdown_it import MarkdownIt
+	return MarkdownIt('commonmark').render
+
+def mistune_engine():
+	import mistune
+	return mistune.create_markdown()
+
+def cmark_engine():
+	import cmarkgfm
+	return cmarkgfm.markdown_to_html
+
+MARKDOWN_ENGINES = {
+	'python-markdown': python_markdown,
+	'markdown-it': markdown_it_engine,
+	'mistune': mistune_engine,
+	'cmark': cmark_engine,
+}
+DEFAULT_MARKDOWN = 'python-markdown'
+
+# Creating a Markdown converter is much slower than reusing one, but they aren't
+# thread-safe, so each thread gets its own.
+markdown_local = threading.local()
+
+def markdown_converter(engine):
+	if not hasattr(markdown_local, 'engines'):
+		markdown_local.engines = {}
+	if engine not in markdown_local.engines:
+		markdown_local.engines[engine] = MARKDOWN_ENGINES[engine]()
+	return markdown_local.engines[engine]
+
+def markdown_to_html(site, s):
+	return markdown_converter(site.markdown)(s)
+
+# One of these is kept for every page of the site; the page text itself is read only when
+# needed and cached in Site.texts (see page_text()).
+class PageInfo:
+	__slots__ = ('tag', 'mtime', 'size', 'hash', 'title', 'menu_pos')
+
+	def __init__(self, tag, mtime, size, hash, title):
+		self.tag = tag
+		self.mtime = mtime
+		self.size = size
+		self.hash = hash
+		self.title = title
+		self.menu_pos = -1 # index in Site.menu_list, set by process_menu()
+
+# A least-recently-used cache that keeps track of the memory its values use.
+class SizedCache:
+	def __init__(self):
+		self.items = OrderedDict() # key -> (value, size), least recently used first
+		self.bytes = 0
+
+	def __len__(self):
+		return len(self.items)
+
+	def get(self, key):
+		item = self.items.get(key)
+		if item is None:
+			return None
+		self.items.move_to_end(key)
+		return item[0]
+
+	def put(self, key, value, size):
+		self.pop(key)
+		self.items[key] = (value, size)
+		self.bytes += size
+
+	def pop(self, key):
+		item = self.items.pop(key, None)
+		if item is not None:
+			self.bytes -= item[1]
+
+	def evict(self):
+		(key, (value, size)) = self.items.popitem(last=False)
+		self.bytes -= size
+
+# Drops the least recently used entries of the largest cache until all of them together
+# fit in @memory; the most recent entry of each is always kept.
+def trim_caches(site):
+	caches = [site.texts, site.parse_cache, site.minify_cache]
+	while sum(c.bytes for c in caches) > site.memory_budget:
+		cache = max(caches, key=lambda c: c.bytes if len(c) > 1 else -1)
+		if len(cache) <= 1:
+			break
+		cache.evict()
+
+# GUI state
+gui = False
+site = None
+current_page = None
 status_label = None
 dirty = False
-want_prevnext = False
-menu_list = []
-macs = ''
 
 with open(os.path.join(starting_folder, '.macros.txt'), 'r') as f:
 	builtin_macros = f.read();
 	if builtin_macros[-1] != '\n':
 		builtin_macros += '\n';
 
+# Traces macro expansion when output_display is set.
+def debug(*args):
+	if output_display:
+		print(*args)
+
 def get_args(s):
 	if s[-1] != '\n':
 		s += '\n'
@@ -55,7 +237,7 @@ def get_args(s):
 	escape = False
 	quoting = False
 	for c in s:
-		print('c', c)
+		debug('c', c)
 		if escape:
 			if c.isdigit():
 				w += '\\' + c # keep arg reference
@@ -92,19 +274,17 @@ def get_args(s):
 				w += c
 	while len(a) < 10:
 		a.append('')
-	print('return from get_args', first_word, a)
+	debug('return from get_args', first_word, a)
 	return (first_word, a)
 
 def subst_args(mac, args):
 	for i in range(len(args)):
 		d = '\\' + str(i)
 		mac = mac.replace(d, args[i])
-		print('replace', d, args[i])
+		debug('replace', d, args[i])
 	return mac
 
-def expand_macro_inner(s):
-	global macros
-
+def expand_macro_inner(s, macros):
 	t = ''
 	had_expansion = False
 	in_macro = False
@@ -113,36 +293,36 @@ def expand_macro_inner(s):
 	while True:
 		if len(macrodef) > 0:
 			x = macrodef[0]
-			print('from macrodef', x)
+			debug('from macrodef', x)
 			macrodef.pop(0)
 		elif len(lines) > 0:
 			x = lines[0]
-			print('from lines', x)
+			debug('from lines', x)
 			lines.pop(0)
 		else:
 			break;
 		if x[0] == '.' and len(macrodef) == 0:
 			(first_word, a) = get_args(x)
-			print('first_word', first_word)
+			debug('first_word', first_word)
 			if len(a) > 0:
 				if first_word == '.de' and len(a) > 1:
-					print('start define', a[1])
+					debug('start define', a[1])
 					in_macro = True
 					mname = a[1]
 					mbody = ''
 					continue
 				elif first_word == '..':
-					print('stop define')
+					debug('stop define')
 					macros[mname] = mbody
-					print('macros', macros)
+					debug('macros', macros)
 					in_macro = False
 					continue
 				else:
 					k = first_word[1:]
-					print('expand1', first_word, k, macros)
+					debug('expand1', first_word, k, macros)
 					if k in macros:
 						had_expansion = True
-						print('expand2', first_word)
+						debug('expand2', first_word)
 						y = subst_args(macros[k], a)
 						macrodef = y.splitlines(True)
 						continue
@@ -150,97 +330,647 @@ def expand_macro_inner(s):
 			mbody += x
 		else:
 			t += x
-	print(macros)
-	print('--------------\n', t)
+	debug(macros)
+	debug('--------------\n', t)
 	return (had_expansion, t)
 
 def expand_macros(s):
-	global xtext, macros
+	global xtext
 
-	macros = {}
+	macros = dict(builtin_defs)
 	b = True
 	while b:
-		(b, s) = expand_macro_inner(s)
-	if output_display:
+		(b, s) = expand_macro_inner(s, macros)
+	if output_display and gui:
 		xtext.delete("1.0", END)
 		xtext.insert(END, s)
 	return s
 
+# The built-in macro definitions are the same for every page of every site, so they're
+# collected once and only the rest of .macros.txt is prepended to each page.
+builtin_defs = {}
+(had_expansion, builtin_text) = expand_macro_inner(builtin_macros, builtin_defs)
+
 def delete_status():
 	status_label.config(text='')
 
 def status(s):
-	status_label.config(text=s)
-	status_label.after(3000, delete_status)
+	if gui:
+		status_label.config(text=s)
+		status_label.after(3000, delete_status)
+	else:
+		print(s)
+
+# Errors are shown in a dialog when using the GUI, and are always added to the build report.
+def error(site, title, err):
+	site.build_report.append(f'{title}: {err}')
+	if gui:
+		messagebox.showerror(title, err)
+	else:
+		print(f'{site.folder}: {title}: {err}', file=sys.stderr)
 
 def html_file(page):
 	ext = '.html'
 	return page + ext
 
-def html_path(page):
-	return os.path.join(PAGES_FOLDER, html_file(page))
+def html_path(site, page):
+	return site.out_path(html_file(page))
 
-def text_path(page):
-	return os.path.join(DATA_FOLDER, page + '.txt')
+def text_path(site, page):
+	return site.data_path(page + '.txt')
 
 def open_site():
-	global site_folder
+	global site
 
 	save_current_page()
-	site_folder = filedialog.askdirectory()
-	if not site_folder:
+	folder = filedialog.askdirectory()
+	if not folder:
 		return;
-	os.chdir(site_folder)
-	if not os.path.exists(DATA_FOLDER):
-		new_site_with_folder(site_folder)
+	if not os.path.exists(os.path.join(folder, DATA_FOLDER)):
+		new_site_with_folder(folder)
 	else:
+		close_site()
+		site = Site(folder)
 		initialize_site()
-	content_label.config(text = f'Content for site "{os.path.basename(site_folder)}"')
+	content_label.config(text = f'Content for site "{os.path.basename(site.folder)}"')
 
 def new_site():
 	new_site_with_folder(None)
 
-def process_fixed_files():
+def close_site():
+	if site and site.sftp:
+		site.sftp.close()
+	if site:
+		close_store(site)
+
+def process_fixed_files(site):
 	try:
-		path = os.path.join(PAGES_FOLDER, 'masonry.pkgd.min.js')
-		shutil.copyfile(os.path.join(starting_folder, 'masonry.pkgd.min.js'), path)
-		sftp_put(path)
-		path = os.path.join(PAGES_FOLDER, 'imagesloaded.pkgd.min.js')
-		shutil.copyfile(os.path.join(starting_folder, 'imagesloaded.pkgd.min.js'), path)
-		sftp_put(path)
+		for name in FIXED_FILES:
+			path = site.out_path(name)
+			src = os.path.join(starting_folder, name)
+			if not os.path.exists(path) or file_hash(src) != asset_hash(site, name):
+				copy_file(site, src, path)
+			publish_asset(site, name, None)
 	except Exception as err:
-		messagebox.showerror("Missing JavaScript File", "@masonary will not work.\n\n" + str(err))
+		error(site, "Missing JavaScript File", "@masonary will not work.\n\n" + str(err))
+
+def file_hash(path):
+	h = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for b in iter(lambda: f.read(65536), b''):
+			h.update(b)
+	return h.hexdigest()
+
+# Replaces dest with a copy of src, or with a hard link if link is True. dest is removed
+# first, since it may be a hard link into an earlier release.
+def copy_file(site, src, dest, link = False):
+	os.makedirs(os.path.dirname(dest), exist_ok=True)
+	if os.path.lexists(dest):
+		os.remove(dest)
+	if link:
+		try:
+			os.link(src, dest)
+		except OSError:
+			shutil.copyfile(src, dest)
+	else:
+		shutil.copyfile(src, dest)
+	record_release_file(site, dest)
+
+# Assets are identified by their path relative to the pages folder. The fixed JavaScript
+# files are copied to where the pages are written.
+def asset_path(site, rel):
+	if rel in FIXED_FILES:
+		return site.out_path(rel)
+	return site.pages_path(rel)
+
+def asset_hash(site, rel):
+	st = os.stat(asset_path(site, rel))
+	entry = site.asset_manifest.get(rel)
+	if entry and entry[1] == st.st_size and entry[2] == st.st_mtime:
+		return entry[0]
+	h = file_hash(asset_path(site, rel))
+	if entry:
+		uploaded = entry[3]
+	else:
+		uploaded = ''
+	site.asset_manifest[rel] = [h, st.st_size, st.st_mtime, uploaded]
+	return h
+
+def load_asset_manifest(site):
+	site.asset_manifest = {}
+	path = site.data_path(ASSET_MANIFEST)
+	if os.path.exists(path):
+		with open(path, 'r') as f:
+			for s in f:
+				a = s.rstrip('\n').split(' ', 4)
+				if len(a) == 5:
+					site.asset_manifest[a[4]] = [a[0], int(a[1]), float(a[2]), a[3].strip('-')]
+
+def save_asset_manifest(site):
+	s = ''
+	for rel in sorted(site.asset_manifest):
+		(h, size, mtime, uploaded) = site.asset_manifest[rel]
+		s += f'{h} {size} {mtime!r} {uploaded or "-"} {rel}\n'
+	write_file(site, site.data_path(ASSET_MANIFEST), s, False)
+
+# Asset references are src and href attributes of tags, and url() in CSS. Script bodies
+# are skipped, so JavaScript can't be mistaken for a reference.
+script_body_re = re.compile(r'(<script\b[^>]*>)(.*?)(?=</script\s*>)', re.I | re.S)
+tag_re = re.compile(r'<[a-zA-Z][^>]*>')
+attr_ref_re = re.compile(r'''(\s(?:src|href)\s*=\s*["']?)([^"'\s>]+)''', re.I)
+css_url_re = re.compile(r'''(url\(\s*["']?)([^"'\s>)]+)''', re.I)
+
+# Returns h with each local asset URL in it replaced by repl(url).
+def replace_asset_refs(h, repl):
+	def ref(m):
+		if is_local_asset(m.group(2)):
+			return m.group(1) + repl(m.group(2))
+		return m.group(0)
+	def refs(s):
+		s = tag_re.sub(lambda t: attr_ref_re.sub(ref, t.group(0)), s)
+		return css_url_re.sub(ref, s)
+	out = []
+	pos = 0
+	for m in script_body_re.finditer(h):
+		out.append(refs(h[pos:m.end(1)]))
+		out.append(m.group(2))
+		pos = m.end()
+	out.append(refs(h[pos:]))
+	return ''.join(out)
+
+# Splits a local asset URL into its path relative to the site and the ?query or #fragment.
+def asset_rel(url):
+	(rel, suffix) = re.match('([^?#]*)(.*)', url).groups()
+	return (os.path.normpath(rel.lstrip('/')).replace(os.sep, '/'), suffix)
+
+def is_local_asset(url):
+	if len(url) == 0 or url[0] == '#' or url.startswith('//') or re.match('^[a-zA-Z][\w+.-]*:', url):
+		return False
+	path = re.split('[?#]', url)[0]
+	return len(path) > 0 and not path.endswith(('.html', '.htm', '.shtml'))
+
+# Returns the URL the page should use for the asset, which is the fingerprinted name if
+# @fingerprint is set. Each asset is hashed, copied, and uploaded at most once per build,
+# and assets with identical contents share one fingerprinted file.
+def publish_asset(site, url, page):
+	(rel, suffix) = asset_rel(url)
+	if rel in site.assets_seen:
+		return site.assets_seen[rel] + suffix
+	src = asset_path(site, rel)
+	if not os.path.isfile(src):
+		site.missing_assets.setdefault(url, set()).add(page)
+		return url
+	old = site.asset_manifest.get(rel)
+	h = asset_hash(site, rel)
+	if site.fingerprint and rel not in FIXED_FILES:
+		if old and old[0] != h:
+			# the copy with the old contents is no longer used
+			(stem, ext) = os.path.splitext(rel)
+			remove_output(site, site.out_path(f'{stem}.{old[0][:10]}{ext}'))
+		if h in site.fingerprints:
+			new_rel = site.fingerprints[h]
+		else:
+			(stem, ext) = os.path.splitext(rel)
+			new_rel = f'{stem}.{h[:10]}{ext}'
+			if not os.path.exists(site.out_path(new_rel)):
+				copy_file(site, src, site.out_path(new_rel), site.release_hashes is not None)
+			upload_asset(site, new_rel, h)
+			site.fingerprints[h] = new_rel
+	else:
+		new_rel = rel
+		dest = site.out_path(rel)
+		if not os.path.exists(dest) or not os.path.samefile(src, dest) and file_hash(dest) != h:
+			copy_file(site, src, dest, True)
+		upload_asset(site, rel, h)
+	site.assets_seen[rel] = new_rel
+	return new_rel + suffix
+
+def upload_asset(site, rel, h):
+	if not site.sftp:
+		return
+	entry = site.asset_manifest.setdefault(rel, [h, 0, 0.0, ''])
+	if entry[3] != h:
+		path = site.out_path(rel)
+		site.uploaded_assets[path] = (rel, h)
+		sftp_put(site, path)
+
+def process_assets(site, page, h):
+	return replace_asset_refs(h, lambda url: publish_asset(site, url, page))
+
+page_link_re = re.compile(r'''\bhref\s*=\s*["']?([^"'\s>]+)''', re.I)
+
+def link_target(url):
+	if len(url) == 0 or url[0] == '#' or url.startswith('//') or re.match('^[a-zA-Z][\w+.-]*:', url):
+		return None
+	path = re.split('[?#]', url)[0]
+	if path.endswith('.html'):
+		return path[:-5]
+	return None
+
+def record_links(site, page, body, prev_link, next_link):
+	targets = set()
+	for url in page_link_re.findall(body):
+		t = link_target(url)
+		if t and t != page:
+			targets.add(t)
+	prev_page = link_target(prev_link or '') or ''
+	next_page = link_target(next_link or '') or ''
+	old = site.links.get(page)
+	if old:
+		for t in set(old[2]) | set(old[:2]):
+			if t in site.backlinks:
+				site.backlinks[t].discard(page)
+	site.links[page] = (prev_page, next_page, sorted(targets))
+	for t in targets | {prev_page, next_page}:
+		if t:
+			site.backlinks.setdefault(t, set()).add(page)
+
+def load_link_index(site):
+	site.links = {}
+	site.backlinks = {}
+	path = site.data_path(LINK_INDEX)
+	if os.path.exists(path):
+		with open(path, 'r') as f:
+			for s in f:
+				a = s.rstrip('\n').split('\t')
+				if len(a) >= 3:
+					site.links[a[0]] = (a[1], a[2], a[3:])
+	path = site.data_path(BACKLINK_INDEX)
+	if os.path.exists(path):
+		with open(path, 'r') as f:
+			for s in f:
+				a = s.rstrip('\n').split('\t')
+				site.backlinks[a[0]] = set(a[1:])
+
+def save_link_index(site):
+	s = ''
+	for page in sorted(site.links):
+		(prev_page, next_page, targets) = site.links[page]
+		s += '\t'.join([page, prev_page, next_page] + targets) + '\n'
+	write_file(site, site.data_path(LINK_INDEX), s, False)
+	s = ''
+	for t in sorted(site.backlinks):
+		if site.backlinks[t]:
+			s += '\t'.join([t] + sorted(site.backlinks[t])) + '\n'
+	write_file(site, site.data_path(BACKLINK_INDEX), s, False)
+
+# Link HTML doesn't depend on the target page, so the only rendered dependency is the
+# Prev/Next links and prefetch hints, which change when the menu order does.
+def rerender_prevnext_changes(site):
+	existing = set(site.pages)
+	for page in sorted(site.links):
+		if page in existing:
+			(prev_link, next_link) = nav_links(site, page)
+			if (link_target(prev_link or '') or '', link_target(next_link or '') or '') != site.links[page][:2]:
+				save_html_page(site, page)
+
+def link_report(site):
+	report = []
+	existing = set(site.pages)
+	in_menu = set(site.menu_list)
+	for page in sorted(site.links):
+		if page not in existing:
+			continue
+		for t in site.links[page][2]:
+			if t not in existing:
+				report.append(f'Broken link in "{page}" to "{t}"')
+	for page in sorted(existing):
+		if page[0] == '@' or page == HOME_PAGE or page in in_menu:
+			continue
+		if not any(p in existing and p != page for p in site.backlinks.get(page, ())):
+			report.append(f'Orphan page "{page}" (not in menu and not linked)')
+	return report
+
+def check_links():
+	if not site:
+		messagebox.showerror("Error", "No site is open.")
+		return
+	save_current_page()
+	report = link_report(site)
+	path = site.data_path(LINK_REPORT_FILE)
+	with open(path, 'w') as f:
+		for s in report:
+			f.write(s + '\n')
+	if report:
+		messagebox.showwarning('Links', '\n'.join(report[:20]) + (f'\n\n(see {path})' if len(report) > 20 else ''))
+	else:
+		messagebox.showinfo('Links', 'No broken links or orphan pages.')
+
+# With @releases N, each build goes into a new folder under releases/ instead of
+# overwriting the pages in place. Unchanged files are hard links to the previous release,
+# the folder is named by a hash of its contents, and the "current" symlink is switched to
+# it in one step once it's complete. The last N releases are kept, for rollback().
+RELEASES_FOLDER = 'releases'
+RELEASE_MANIFEST = '.manifest'
+RELEASE_HISTORY = 'history'
+CURRENT_LINK = 'current'
+
+def begin_release(site):
+	releases = os.path.join(site.folder, RELEASES_FOLDER)
+	staging = os.path.join(releases, '.staging')
+	if os.path.exists(staging):
+		shutil.rmtree(staging)
+	os.makedirs(staging)
+	site.release_hashes = {}
+	current = os.path.join(site.folder, CURRENT_LINK)
+	if os.path.isdir(current):
+		files = [(rel, os.path.join(current, rel), h) for (rel, h) in read_release_manifest(current).items()]
+	else:
+		# the first release starts from the pages built in place, if there are any
+		files = [(rel, path, None) for (rel, path) in publish_list(site)]
+	for (rel, path, h) in files:
+		if not os.path.exists(path):
+			continue
+		dest = os.path.join(staging, rel)
+		os.makedirs(os.path.dirname(dest), exist_ok=True)
+		os.link(path, dest)
+		site.release_hashes[rel] = h or file_hash(path)
+	site.out_folder = staging
+	# pages include these, so they must be there even if only one page is built
+	for (page, name) in (('@header', 'header.html'), ('@footer', 'footer.html'), ('@site.css', 'site.css'), ('@menu', 'menu.html')):
+		if page in site.pages and not os.path.exists(site.out_path(name)):
+			save_html_page(site, page)
+
+def record_release_file(site, path):
+	if site.release_hashes is not None and path.startswith(site.out_folder + os.sep):
+		site.release_hashes[os.path.relpath(path, site.out_folder).replace(os.sep, '/')] = file_hash(path)
+
+# Removes a generated file, and drops it from the release being built.
+def remove_output(site, path):
+	if os.path.exists(path):
+		os.remove(path)
+	if site.release_hashes is not None and path.startswith(site.out_folder + os.sep):
+		site.release_hashes.pop(os.path.relpath(path, site.out_folder).replace(os.sep, '/'), None)
+
+def read_release_manifest(folder):
+	hashes = {}
+	path = os.path.join(folder, RELEASE_MANIFEST)
+	if os.path.exists(path):
+		with open(path, 'r') as f:
+			for s in f:
+				(h, rel) = s.rstrip('\n').split(' ', 1)
+				hashes[rel] = h
+	return hashes
+
+def finish_release(site):
+	staging = site.out_folder
+	manifest = ''.join(f'{site.release_hashes[rel]} {rel}\n' for rel in sorted(site.release_hashes))
+	release = hashlib.sha1(manifest.encode()).hexdigest()[:16]
+	site.out_folder = None
+	site.release_hashes = None
+	folder = os.path.join(site.folder, RELEASES_FOLDER, release)
+	if os.path.exists(folder):
+		shutil.rmtree(staging)
+	else:
+		with open(os.path.join(staging, RELEASE_MANIFEST), 'w') as f:
+			f.write(manifest)
+		os.rename(staging, folder)
+	switch_release(site, release)
+	history = [r for r in read_release_history(site) if r != release] + [release]
+	for r in history[:-site.releases]:
+		shutil.rmtree(os.path.join(site.folder, RELEASES_FOLDER, r), ignore_errors=True)
+	history = history[-site.releases:]
+	with open(os.path.join(site.folder, RELEASES_FOLDER, RELEASE_HISTORY), 'w') as f:
+		f.write(''.join(r + '\n' for r in history))
+	site.build_report.append(f'Published release {release}')
+
+def read_release_history(site):
+	path = os.path.join(site.folder, RELEASES_FOLDER, RELEASE_HISTORY)
+	if not os.path.exists(path):
+		return []
+	with open(path, 'r') as f:
+		return [s.strip() for s in f if s.strip()]
+
+def current_release(site):
+	current = os.path.join(site.folder, CURRENT_LINK)
+	if os.path.islink(current):
+		return os.path.basename(os.readlink(current))
+	return None
+
+def switch_release(site, release):
+	current = os.path.join(site.folder, CURRENT_LINK)
+	tmp = current + '.tmp'
+	if os.path.lexists(tmp):
+		os.remove(tmp)
+	os.symlink(os.path.join(RELEASES_FOLDER, release), tmp)
+	os.replace(tmp, current)
+
+# Switches back to the given release, or to the one before the current one.
+def rollback(site, release = None):
+	history = read_release_history(site)
+	if not release:
+		current = current_release(site)
+		if current not in history or history.index(current) == 0:
+			raise ValueError('No earlier release to roll back to')
+		release = history[history.index(current) - 1]
+	if release not in history:
+		raise ValueError(f'No release {release}')
+	switch_release(site, release)
+	return release
+
+def begin_build(site):
+	site.assets_seen = {}
+	site.fingerprints = {}
+	site.missing_assets = {}
+	site.build_report = []
+	site.num_successful = 0
+	site.num_attempted = 0
+	site.bytes_saved = 0
+	site.changed = []
+	site.uploaded_assets = {}
+	site.budget_failures = []
+	if site.releases:
+		try:
+			begin_release(site)
+		except Exception:
+			abort_build(site)
+			raise
+
+# Called when a build fails part way: the release being built is thrown away.
+def abort_build(site):
+	if site.release_hashes is not None:
+		shutil.rmtree(site.out_folder, ignore_errors=True)
+		site.out_folder = None
+		site.release_hashes = None
+
+# Names a written file for reports: outputs relative to the release being built, anything
+# else relative to the site folder.
+def output_name(site, path):
+	if site.out_folder and path.startswith(site.out_folder + os.sep):
+		return os.path.relpath(path, site.out_folder)
+	return os.path.relpath(path, site.folder)
+
+def end_build(site):
+	if site.site_url:
+		write_sitemap(site)
+	finish_uploads(site) # before the release is moved out of the staging folder
+	if site.release_hashes is not None:
+		finish_release(site)
+	save_asset_manifest(site)
+	save_link_index(site)
+	save_weight_index(site)
+	weight_report(site)
+	for url in sorted(site.missing_assets):
+		referrers = ', '.join(sorted(p for p in site.missing_assets[url] if p))
+		site.build_report.append(f'Missing asset "{url}" referenced by {referrers}')
+	if site.minify:
+		site.build_report.append(f'Minification saved {site.bytes_saved} bytes')
+	if site.changed:
+		site.build_report.append(f'{len(site.changed)} files changed:')
+		for name in site.changed:
+			site.build_report.append('\t' + name)
+	else:
+		site.build_report.append('No files changed')
+	write_file(site, site.data_path(REPORT_FILE), ''.join(s + '\n' for s in site.build_report), False)
+	return len(site.missing_assets)
+
+# The size of every page is recorded as it's written and kept in WEIGHT_INDEX, so the
+# build report can list the biggest pages of the whole site. Metrics:
+#   html    bytes of the page itself
+#   css     bytes of inline <style>
+#   js      bytes of inline <script>
+#   menu    bytes of the menu copied into the page
+#   images  number of <img> tags, including those in @cellchunk fragments
+#   assets  bytes of the local files the page refers to, including those in fragments
+# @budget METRIC LIMIT adds a warning to the report for pages over the limit (which may
+# end in K or M); with "fail" after the limit, headless builds fail too.
+WEIGHT_INDEX = 'weights.index'
+PAGE_METRICS = ['html', 'css', 'js', 'menu', 'images', 'assets']
+style_re = re.compile(r'<style\b[^>]*>(.*?)</style\s*>', re.I | re.S)
+inline_script_re = re.compile(r'<script\b(?![^>]*\bsrc\s*=)[^>]*>(.*?)</script\s*>', re.I | re.S)
+menu_div_re = re.compile(r'<div id=menu\b.*?</div>', re.S)
+img_re = re.compile(r'<img\b', re.I)
+
+def parse_size(s):
+	scale = {'K': 1024, 'M': 1024 * 1024}.get(s[-1:].upper(), 1)
+	return int(s.rstrip('kKmM')) * scale
+
+def record_page_weight(site, page, h, sources):
+	assets = set()
+	for src in sources:
+		replace_asset_refs(src, lambda url: assets.add(asset_rel(url)[0]) or url)
+	weight = {
+		'html': len(h.encode()),
+		'css': sum(len(m.group(1).encode()) for m in style_re.finditer(h)),
+		'js': sum(len(m.group(1).encode()) for m in inline_script_re.finditer(h)),
+		'menu': sum(len(m.group(0).encode()) for m in menu_div_re.finditer(h)),
+		'images': sum(len(img_re.findall(src)) for src in sources),
+		'assets': sum(site.asset_manifest[rel][1] for rel in assets if rel in site.asset_manifest),
+	}
+	site.page_weights[page] = weight
+	for (metric, (limit, fail)) in site.budgets.items():
+		if weight[metric] > limit:
+			site.build_report.append(f'{"Over budget" if fail else "Warning"}: {page} has {metric} {weight[metric]} (budget {limit})')
+			if fail:
+				site.budget_failures.append(page)
+
+def load_weight_index(site):
+	site.page_weights = {}
+	path = site.data_path(WEIGHT_INDEX)
+	if os.path.exists(path):
+		with open(path, 'r') as f:
+			for s in f:
+				a = s.rstrip('\n').split('\t')
+				if len(a) == len(PAGE_METRICS) + 1:
+					site.page_weights[a[0]] = dict(zip(PAGE_METRICS, map(int, a[1:])))
+
+def save_weight_index(site):
+	for page in list(site.page_weights):
+		if page not in site.pages:
+			del site.page_weights[page]
+	s = ''
+	for page in sorted(site.page_weights):
+		s += '\t'.join([page] + [str(site.page_weights[page][k]) for k in PAGE_METRICS]) + '\n'
+	write_file(site, site.data_path(WEIGHT_INDEX), s, False)
+
+def weight_report(site):
+	if not site.page_weights:
+		return
+	site.build_report.append('Largest pages:')
+	for metric in PAGE_METRICS:
+		top = sorted(site.page_weights, key=lambda p: site.page_weights[p][metric], reverse=True)[:5]
+		total = sum(w[metric] for w in site.page_weights.values())
+		site.build_report.append(f'\t{metric} (site total {total}): ' + ', '.join(f'{p} {site.page_weights[p][metric]}' for p in top if site.page_weights[p][metric]))
+
+# With @siteurl, sitemap.xml lists every page. The date a page last changed is kept in
+# SITEMAP_INDEX along with the hash of its source, so it changes only when the text does.
+SITEMAP_INDEX = 'sitemap.index'
+
+def write_sitemap(site):
+	state = {}
+	path = site.data_path(SITEMAP_INDEX)
+	if os.path.exists(path):
+		with open(path, 'r') as f:
+			for s in f:
+				(page, h, lastmod) = s.rstrip('\n').split('\t')
+				state[page] = (h, lastmod)
+	pages = [p for p in site.pages if p[0] != '@']
+	for page in pages:
+		info = site.pages[page]
+		if page not in state or state[page][0] != info.hash:
+			state[page] = (info.hash, time.strftime('%Y-%m-%d', time.gmtime(info.mtime)))
+	xml = '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+	for page in pages:
+		url = site.site_url + '/' + ('' if page == HOME_PAGE else html_file(page))
+		xml += f'<url><loc>{html.escape(url)}</loc><lastmod>{state[page][1]}</lastmod></url>\n'
+	xml += '</urlset>\n'
+	if write_file(site, site.out_path('sitemap.xml'), xml):
+		sftp_put(site, site.out_path('sitemap.xml'))
+	write_file(site, path, ''.join(f'{p}\t{state[p][0]}\t{state[p][1]}\n' for p in pages), False)
+
+# Writes s to path unless the file already has exactly that content, so unchanged outputs
+# keep their modification times. Returns True if the file was written; written files are
+# listed in the build report if record is True.
+def write_file(site, path, s, record = True):
+	try:
+		if os.linesep != '\n' or os.path.getsize(path) == len(s.encode()):
+			with open(path, 'r') as f:
+				if f.read() == s:
+					return False
+	except (OSError, UnicodeDecodeError):
+		pass
+	# Writing a new file and renaming it over the old one means a file that's hard-linked
+	# into an earlier release is replaced, not changed.
+	tmp = path + '.tmp'
+	with open(tmp, 'w') as f:
+		f.write(s)
+	os.replace(tmp, path)
+	record_release_file(site, path)
+	if record:
+		site.changed.append(output_name(site, path))
+	return True
 
 def new_site_with_folder(folder):
-	global site_folder
+	global site, current_page
 
 	save_current_page()
 	current_page = None
 	content_label.config(text = '')
 
-	if folder:
-		site_folder = site_folder
-	else:
-		site_folder = filedialog.askdirectory()
-	if not site_folder:
+	if not folder:
+		folder = filedialog.askdirectory()
+	if not folder:
 		return;
-	os.chdir(site_folder)
-	if not os.path.exists(DATA_FOLDER):
-		os.mkdir(DATA_FOLDER)
-	if not os.path.exists(PAGES_FOLDER):
-		os.mkdir(PAGES_FOLDER)
-	process_fixed_files()
-	with open(text_path('@header'), 'w') as f:
+	close_site()
+	site = Site(folder)
+	create_site(site)
+	initialize_site()
+
+def create_site(site):
+	if not os.path.exists(site.data_path('')):
+		os.mkdir(site.data_path(''))
+	if not os.path.exists(site.pages_path('')):
+		os.mkdir(site.pages_path(''))
+	process_fixed_files(site)
+	with open(text_path(site, '@header'), 'w') as f:
 		f.write('**Page Header**\n')
-	save_html_page('@header')
-	with open(text_path('@footer'), 'w') as f:
+	with open(text_path(site, '@footer'), 'w') as f:
 		f.write('*Page Footer*\n')
-	save_html_page('@footer')
-	with open(text_path('@settings'), 'w') as f:
+	with open(text_path(site, '@settings'), 'w') as f:
 		f.write('\n')
-	with open(text_path('@macros'), 'w') as f:
+	with open(text_path(site, '@macros'), 'w') as f:
 		f.write('\n')
-	with open(text_path('@site.css'), 'w') as f:
+	with open(text_path(site, '@site.css'), 'w') as f:
 		f.write('''#page-footer {
 }
 #page-header {
@@ -258,181 +988,601 @@ def new_site_with_folder(folder):
 #main p {
 }
 			''')
-	save_html_page('@site.css')
-	with open(text_path('@menu'), 'w') as f:
+	with open(text_path(site, '@menu'), 'w') as f:
 		f.write(HOME_PAGE + '\n')
-	with open(text_path(HOME_PAGE), 'w') as f:
+	with open(text_path(site, HOME_PAGE), 'w') as f:
 		f.write('@title Home Page\nThis is the home page.\n')
-	save_html_page('@menu')
-	save_html_page(HOME_PAGE)
-	initialize_site()
+	# the menu looks up page titles, so every page has to be registered before anything is saved
+	refresh_pages(site)
+	for p in ['@header', '@footer', '@site.css', '@menu', HOME_PAGE]:
+		save_html_page(site, p)
 
 def initialize_site():
-	global pages, current_page
-
-	p = text_path('@macros')
-	if not os.path.exists(p):
-		with open(p, 'w') as f:
-			f.write('\n')
+	global current_page
 
 	pagetext.delete("1.0", END)
 	current_page = None
-	pages = []
-	with os.scandir(DATA_FOLDER) as it:
+	load_site(site)
+	populate_pages_listbox()
+
+def load_site(site):
+	open_store(site)
+	if not page_exists(site, '@macros'):
+		write_page_source(site, '@macros', '\n', False)
+	load_page_index(site)
+	refresh_pages(site)
+	load_macros(site)
+	load_asset_manifest(site)
+	load_link_index(site)
+	load_weight_index(site)
+	process_settings(site);
+
+def load_page_index(site):
+	site.pages = {}
+	path = site.data_path(PAGE_INDEX)
+	if os.path.exists(path):
+		with open(path, 'r') as f:
+			for s in f:
+				a = s.rstrip('\n').split('\t')
+				if len(a) == 5:
+					site.pages[a[0]] = PageInfo(a[0], float(a[1]), int(a[2]), a[3], a[4])
+
+def save_page_index(site):
+	s = ''.join(f'{info.tag}\t{info.mtime!r}\t{info.size}\t{info.hash}\t{info.title}\n' for info in site.pages.values())
+	write_file(site, site.data_path(PAGE_INDEX), s, False)
+
+# With data/SITE_DB, page sources are kept in one SQLite database instead of a .txt file
+# per page, and the .txt files are only read by import_pages(). Titles, params and hashes
+# are stored with the text, so the registry is loaded with one query, and pages are
+# indexed for the page list filter if SQLite has FTS5. export_pages() writes the .txt
+# files back out for editing with other programs.
+SITE_DB = 'site.db'
+
+def open_store(site):
+	path = site.data_path(SITE_DB)
+	if os.path.exists(path):
+		(site.db, site.db_fts) = connect_store(path)
+
+def close_store(site):
+	if site.db:
+		site.db.close()
+		site.db = None
+
+def connect_store(path):
+	db = sqlite3.connect(path)
+	db.execute('CREATE TABLE IF NOT EXISTS pages (tag TEXT PRIMARY KEY, text TEXT, hash TEXT, title TEXT, params TEXT, mtime REAL)')
+	try:
+		db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5(tag UNINDEXED, title, text)')
+		fts = True
+	except sqlite3.OperationalError:
+		fts = False # the filter then matches tags and titles only
+	db.commit()
+	return (db, fts)
+
+# Stores the text of a page without committing; returns True if it changed.
+def store_page(site, page, text):
+	h = hashlib.sha1(text.encode()).hexdigest()
+	row = site.db.execute('SELECT hash FROM pages WHERE tag = ?', (page,)).fetchone()
+	if row and row[0] == h:
+		return False
+	params = parse_params(text)[0]
+	site.db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)', (page, text, h, params['title'], json.dumps(params), time.time()))
+	if site.db_fts:
+		site.db.execute('DELETE FROM pages_fts WHERE tag = ?', (page,))
+		site.db.execute('INSERT INTO pages_fts VALUES (?, ?, ?)', (page, params['title'], text))
+	return True
+
+def read_page_source(site, page):
+	if site.db:
+		row = site.db.execute('SELECT text FROM pages WHERE tag = ?', (page,)).fetchone()
+		if not row:
+			raise FileNotFoundError(f'No page {page} in {SITE_DB}')
+		return row[0]
+	with open(text_path(site, page), 'r') as f:
+		return f.read()
+
+# Returns True if the text of the page changed.
+def write_page_source(site, page, text, record = True):
+	if site.db:
+		with site.db:
+			return store_page(site, page, text)
+	return write_file(site, text_path(site, page), text, record)
+
+def page_exists(site, page):
+	if site.db:
+		return site.db.execute('SELECT 1 FROM pages WHERE tag = ?', (page,)).fetchone() is not None
+	return os.path.exists(text_path(site, page))
+
+# Pages whose tag or title contains s, or with FTS5, pages matching each word of s.
+def find_pages(site, s):
+	words = s.split()
+	if not words:
+		return list(site.pages)
+	if site.db and site.db_fts:
+		query = ' '.join('"' + w.replace('"', '""') + '"*' for w in words)
+		found = set(r[0] for r in site.db.execute('SELECT tag FROM pages_fts WHERE pages_fts MATCH ?', (query,)))
+		return [p for p in site.pages if p in found]
+	return [p for p in site.pages if all(w.casefold() in (p + ' ' + site.pages[p].title).casefold() for w in words)]
+
+# Copies the .txt files of a site into its database, creating it if needed. A page that
+# was changed in the database after its .txt file was written is skipped unless force is
+# set, and pages with no .txt file are only removed from the database with prune.
+def import_pages(folder, prune = False, force = False):
+	site = Site(folder)
+	(site.db, site.db_fts) = connect_store(site.data_path(SITE_DB))
+	tags = set()
+	changed = 0
+	skipped = []
+	removed = []
+	with site.db:
+		with os.scandir(site.data_path('')) as it:
+			for entry in it:
+				if entry.name.endswith('.txt'):
+					tag = os.path.splitext(entry.name)[0]
+					tags.add(tag)
+					with open(entry.path, 'r') as f:
+						text = f.read()
+					# a page saved in the database after the .txt was written would be lost
+					row = site.db.execute('SELECT text, mtime FROM pages WHERE tag = ?', (tag,)).fetchone()
+					if not force and row and row[1] > entry.stat().st_mtime and row[0] != text:
+						skipped.append(tag)
+						continue
+					if store_page(site, tag, text):
+						changed += 1
+		if prune:
+			removed = [r[0] for r in site.db.execute('SELECT tag FROM pages') if r[0] not in tags]
+		for tag in removed:
+			site.db.execute('DELETE FROM pages WHERE tag = ?', (tag,))
+			if site.db_fts:
+				site.db.execute('DELETE FROM pages_fts WHERE tag = ?', (tag,))
+	close_store(site)
+	for tag in skipped:
+		print(f'{tag}: the page in {SITE_DB} is newer than {tag}.txt; run export first, or import --force to overwrite it', file=sys.stderr)
+	status(f'Imported {len(tags) - len(skipped)} pages into {SITE_DB}: {changed} changed, {len(removed)} removed, {len(skipped)} skipped')
+	return not skipped
+
+# Writes every page in the database of a site to its .txt file.
+def export_pages(folder):
+	site = Site(folder)
+	open_store(site)
+	if not site.db:
+		print(f'{site.data_path(SITE_DB)} does not exist', file=sys.stderr)
+		return False
+	changed = 0
+	total = 0
+	for (tag, text) in site.db.execute('SELECT tag, text FROM pages'):
+		total += 1
+		if write_file(site, text_path(site, tag), text, False):
+			changed += 1
+	close_store(site)
+	status(f'Exported {total} pages from {SITE_DB}: {changed} changed')
+	return True
+
+# Brings the registry up to date with data/ in one pass, reading only new or changed pages.
+def refresh_pages(site):
+	if site.db:
+		refresh_pages_from_store(site)
+		return
+	pages = {}
+	changed = False
+	with os.scandir(site.data_path('')) as it:
 		for entry in it:
 			if entry.name.endswith('.txt'):
 				(f, e) = os.path.splitext(entry.name)
-				pages.append(f)
-	populate_pages_listbox()
-	process_settings();
+				st = entry.stat()
+				info = site.pages.get(f)
+				if not info or info.mtime != st.st_mtime or info.size != st.st_size:
+					info = read_page_info(site, f)
+					changed = True
+				pages[f] = info
+	changed = changed or len(pages) != len(site.pages)
+	for tag in site.pages:
+		if tag not in pages:
+			forget_text(site, tag)
+	site.pages = {tag: pages[tag] for tag in sorted(pages, key=str.casefold)}
+	if changed:
+		save_page_index(site)
+
+def refresh_pages_from_store(site):
+	pages = {}
+	for (tag, mtime, size, h, title) in site.db.execute('SELECT tag, mtime, length(CAST(text AS BLOB)), hash, title FROM pages'):
+		info = PageInfo(tag, mtime, size, h, title)
+		old = site.pages.get(tag)
+		if old:
+			info.menu_pos = old.menu_pos
+		if not old or old.hash != h:
+			forget_text(site, tag)
+		pages[tag] = info
+	for tag in site.pages:
+		if tag not in pages:
+			forget_text(site, tag)
+	site.pages = {tag: pages[tag] for tag in sorted(pages, key=str.casefold)}
+
+def read_page_info(site, page):
+	forget_text(site, page)
+	if site.db:
+		(mtime, size, h, title) = site.db.execute('SELECT mtime, length(CAST(text AS BLOB)), hash, title FROM pages WHERE tag = ?', (page,)).fetchone()
+		info = PageInfo(page, mtime, size, h, title)
+	else:
+		path = text_path(site, page)
+		st = os.stat(path)
+		with open(path, 'r') as f:
+			s = f.read()
+		info = PageInfo(page, st.st_mtime, st.st_size, hashlib.sha1(s.encode()).hexdigest(), parse_params(s)[0]['title'])
+	if page in site.pages:
+		info.menu_pos = site.pages[page].menu_pos
+	return info
+
+# Pages can be changed by an external editor, so the GUI checks before showing one.
+def check_page(site, page):
+	info = site.pages.get(page)
+	if site.db:
+		row = site.db.execute('SELECT hash FROM pages WHERE tag = ?', (page,)).fetchone()
+		if not info or not row or info.hash != row[0]:
+			add_page(site, page)
+		return
+	st = os.stat(text_path(site, page))
+	if not info or info.mtime != st.st_mtime or info.size != st.st_size:
+		add_page(site, page)
+
+def add_page(site, page):
+	site.pages[page] = read_page_info(site, page)
+	site.pages = {tag: site.pages[tag] for tag in sorted(site.pages, key=str.casefold)}
+	if not site.db:
+		save_page_index(site)
+
+def page_text(site, page):
+	s = site.texts.get(page)
+	if s is not None:
+		return s
+	s = read_page_source(site, page)
+	site.texts.put(page, s, sys.getsizeof(s))
+	trim_caches(site)
+	return s
 
-def populate_pages_listbox():
-	global pages, pagelistbox
+def forget_text(site, page):
+	site.texts.pop(page)
 
-	pages = sorted(pages, key=str.casefold)
+def load_macros(site):
+	site.macs = page_text(site, '@macros')
+	if len(site.macs) == 0 or site.macs[-1] != '\n':
+		site.macs += '\n'
+
+def populate_pages_listbox(*args):
 	pagelistbox.delete(0, END)
-	for p in pages:
-		pagelistbox.insert(END, p)
+	if site:
+		for p in find_pages(site, page_filter.get()):
+			pagelistbox.insert(END, p)
 
 def select_page(e = None):
-	global current_page, site_folder
+	global current_page
 
 	save_current_page()
 	n = pagelistbox.curselection()
 	if n:
 		current_page = pagelistbox.get(n[0])
-		with open(os.path.join(DATA_FOLDER, current_page + '.txt.'), 'r') as f:
-			s = f.read()
+		check_page(site, current_page)
+		s = page_text(site, current_page)
 		pagetext.delete("1.0", END)
 		pagetext.insert(END, s)
 		reset_changed()
-		content_label.config(text = f'Content for site "{os.path.basename(site_folder)}", page "{current_page}"')
+		content_label.config(text = f'Content for site "{os.path.basename(site.folder)}", page "{current_page}"')
 	else:
 		print("No item selected")
 
-def get_prevnext(page):
-	global want_prevnext, menu_list
-
-	if not want_prevnext:
+# The Prev and Next links shown on a page with @prevnext.
+def get_prevnext(site, page):
+	if not site.want_prevnext:
 		return (None, None)
-	prev_link = None
-	next_link = None
-	want_next = False
-	for p in menu_list:
-		if p == page:
-			want_next = True
-		else:
-			if want_next:
-				next_link = p + '.html'
-				break
-			else:
-				prev_link = p + '.html'
+	if menu_position(site, page) < 0:
+		# a page that isn't in the menu gets the last page as Prev
+		return (html_file(site.menu_list[-1]) if site.menu_list else None, None)
+	return menu_neighbours(site, page)
+
+def menu_position(site, page):
+	info = site.pages.get(page)
+	pos = info.menu_pos if info else -1
+	if pos < 0 or pos >= len(site.menu_list) or site.menu_list[pos] != page:
+		return -1
+	return pos
+
+# The pages before and after a page in the menu, whether or not @prevnext is set.
+def menu_neighbours(site, page):
+	menu = site.menu_list
+	pos = menu_position(site, page)
+	if pos < 0:
+		return (None, None)
+	prev_link = html_file(menu[pos - 1]) if pos > 0 else None
+	next_link = html_file(menu[pos + 1]) if pos + 1 < len(menu) else None
 	return (prev_link, next_link)
 
-def write_html(page, s, expand = True):
-	global macs
-
-	s = expand_macros(builtin_macros + macs + s)
-	(prev_link, next_link) = get_prevnext(page)
-	local_path = html_path(page)
-	h = build_html(page, s, prev_link, next_link, expand)
-	with open(local_path, 'w') as f:
-		f.write(h)
-	sftp_put(local_path)
-
-def save_html_page(page, expand = True):
-	with open(text_path(page), 'r') as f:
-		text = f.read()
+# The previous and next pages a page links to or prefetches; recorded in the link index.
+def nav_links(site, page):
+	if site.want_prevnext:
+		return get_prevnext(site, page)
+	return menu_neighbours(site, page)
+
+def write_html(site, page, s, expand = True):
+	s = expand_macros(builtin_text + site.macs + s)
+	(prev_link, next_link) = get_prevnext(site, page)
+	local_path = html_path(site, page)
+	(h, fragments) = build_html(site, page, s, prev_link, next_link, expand)
+	sources = [h] + fragments
+	h = process_assets(site, page, h)
+	if site.minify:
+		h = minify(site, html_file(page), h, 'html')
+	if write_file(site, local_path, h):
+		sftp_put(site, local_path)
+	for (k, f) in enumerate(fragments, 1):
+		path = html_path(site, f'{page}.cells{k}')
+		f = process_assets(site, page, f)
+		if site.minify:
+			f = minify(site, os.path.basename(path), f, 'html')
+		if write_file(site, path, f):
+			sftp_put(site, path)
+	k = len(fragments) + 1
+	while os.path.exists(html_path(site, f'{page}.cells{k}')):
+		remove_output(site, html_path(site, f'{page}.cells{k}'))
+		k += 1
+	record_page_weight(site, page, h, sources)
+
+def save_html_page(site, page, expand = True):
+	text = page_text(site, page)
 	if (page[0] != '@'):
-		write_html(page, text, expand)
+		write_html(site, page, text, expand)
 	elif page == '@site.css':
-		css_path = os.path.join(PAGES_FOLDER, 'site.css')
-		with open(css_path, 'w') as f:
-			f.write(text);
-		sftp_put(css_path)
+		css_path = site.out_path('site.css')
+		if site.minify:
+			text = minify(site, 'site.css', text, 'css')
+		if write_file(site, css_path, text):
+			sftp_put(site, css_path)
 	elif page == '@settings':
-		process_settings()
+		process_settings(site)
+	elif page == '@macros':
+		load_macros(site)
 	elif page == '@menu':
-		process_menu();
+		process_menu(site);
 	elif page == '@header' or page == '@footer':
-		with open(text_path(page), 'r') as f:
-			path = html_path(page[1:])
-			s = f.read()
-			with open(path, 'w') as out:
-				out.write(markdown.markdown(s))
-			sftp_put(path)
+		path = html_path(site, page[1:])
+		h = markdown_to_html(site, text)
+		if site.minify:
+			h = minify(site, html_file(page[1:]), h, 'html')
+		if write_file(site, path, h):
+			sftp_put(site, path)
 
 def save_current_page():
-	global num_successful, macs
-
-	if not dirty:
+	if not dirty or not site:
 		return
-	num_successful = 0
-	if current_page:
-		with open(text_path('@macros'), 'r') as f:
-			macs = f.read()
-		if macs[-1] != '\n':
-			macs += '\n'
-		text = pagetext.get("1.0", END)
-		with open(text_path(current_page), 'w') as f:
-			f.write(text.strip())
-		save_html_page(current_page)
-	reset_changed()
-	process_menu() # in case title changed
-	if sftp and num_successful == 2:
+	begin_build(site)
+	try:
+		old_menu_list = site.menu_list
+		if current_page:
+			load_macros(site)
+			text = pagetext.get("1.0", END)
+			save_page_text(site, current_page, text)
+		reset_changed()
+		process_menu(site) # in case title changed
+		if site.menu_list != old_menu_list:
+			rerender_prevnext_changes(site)
+	except Exception:
+		abort_build(site)
+		raise
+	end_build(site)
+	if site.sftp and site.num_successful == site.num_attempted:
 		status('Uploaded OK')
 	status(f'Saved "{current_page}"')
 
+def save_page_text(site, page, text):
+	if write_page_source(site, page, text.strip()):
+		add_page(site, page)
+	save_html_page(site, page)
+
+def finish_uploads(site):
+	if not site.sftp:
+		return
+	results = site.sftp.wait()
+	failed = []
+	for path in sorted(results):
+		name = os.path.relpath(path, site.folder)
+		if results[path] is None:
+			site.num_successful += 1
+			site.build_report.append(f'Uploaded {name}')
+			if path in site.uploaded_assets:
+				(rel, h) = site.uploaded_assets[path]
+				site.asset_manifest[rel][3] = h
+		else:
+			failed.append(f'{name}: {results[path]}')
+			site.build_report.append(f'Upload FAILED {name}: {results[path]}')
+	site.num_attempted = len(results)
+	if failed:
+		error(site, "FTP Put Error", '\n'.join(failed[:20]))
+
 # The @settings.txt file is for SFTP parameters, but SFTP is not enabled.
 # The file is still present in case some other settings are introduced in the future.
-def process_settings():
-	global sftp_host, sftp_username, sftp_password, sftp_path, sftp, want_prevnext
-
-	want_prevnext = False
+def process_settings(site):
+	site.want_prevnext = False
+	site.fingerprint = False
+	site.minify = False
+	site.shared_menu = False
+	site.releases = 0
+	site.budgets = {}
+	site.site_url = None
+	site.markdown = DEFAULT_MARKDOWN
+	site.memory_budget = MEMORY_BUDGET
 	# disable sftp -- using S3 only
-	sftp = None
-	sftp_host = None
-	sftp_username = None
-	sftp_password = None
-	sftp_path = None
-	with open(text_path('@settings'), 'r') as f:
-		for s in f:
-			m = re.match('^@([^ ]*) *(.*)$', s)
-			if m:
+	if site.sftp:
+		site.sftp.close()
+	site.sftp = None
+	site.sftp_host = None
+	site.sftp_username = None
+	site.sftp_password = None
+	site.sftp_path = None
+	for s in page_text(site, '@settings').splitlines():
+		m = re.match('^@([^ ]*) *(.*)$', s.strip())
+		if m:
+			# a bad number is reported like any other mistake, and the line is ignored
+			try:
 				match m.group(1):
 					case 'host':
-						sftp_host = m.group(2).strip()
+						site.sftp_host = m.group(2).strip()
 					case 'username':
-						sftp_username = m.group(2).strip()
+						site.sftp_username = m.group(2).strip()
 					case 'password':
-						sftp_password = m.group(2).strip()
+						site.sftp_password = m.group(2).strip()
 					case 'path':
-						sftp_path = m.group(2).strip()
+						site.sftp_path = m.group(2).strip()
 					case 'prevnext':
-						want_prevnext = True
-						process_menu()
-	if sftp_host and sftp_username and sftp_password and sftp_path:
-		try:
+						site.want_prevnext = True
+					case 'fingerprint':
+						site.fingerprint = True
+					case 'sharedmenu':
+						site.shared_menu = True
+					case 'budget':
+						a = m.group(2).split()
+						if len(a) >= 2 and a[0] in PAGE_METRICS:
+							site.budgets[a[0]] = (parse_size(a[1]), a[2:] == ['fail'])
+						else:
+							error(site, 'Settings', f'Expected "@budget METRIC LIMIT [fail]" with a metric from {", ".join(PAGE_METRICS)}')
+					case 'siteurl':
+						site.site_url = m.group(2).strip().rstrip('/') or None
+					case 'releases':
+						site.releases = max(1, int(m.group(2).strip() or 5))
+					case 'minify':
+						site.minify = True
+					case 'memory':
+						site.memory_budget = int(m.group(2).strip()) * 1024 * 1024
+					case 'markdown':
+						engine = m.group(2).strip()
+						try:
+							markdown_converter(engine)
+							site.markdown = engine
+						except KeyError:
+							error(site, 'Settings', f'Unknown Markdown engine {engine}; choose from {", ".join(MARKDOWN_ENGINES)}')
+						except ImportError as err:
+							error(site, 'Settings', f'Markdown engine {engine} is not installed: {err}')
+			except ValueError as err:
+				error(site, 'Settings', f'Bad value in "{s.strip()}": {err}')
+	process_menu(site, False)
+	if site.sftp_host and site.sftp_username and site.sftp_password and site.sftp_path:
+		def connect():
 			cnopts = pysftp.CnOpts()
 			cnopts.hostkeys = None
-			sftp = pysftp.Connection(sftp_host, username=sftp_username, password=sftp_password, port=7822, cnopts=cnopts)
-			sftp.chdir(sftp_path) # using default_path arg to constructor doesn't report errors
-		except Exception as err:
-			messagebox.showerror("FTP Connection Error", err)
-			sftp = None
-		else:
-			status(f'Connected to {sftp_host} at {sftp_path}')
-
-def sftp_put(path):
-	global num_successful
-
-	if sftp:
+			conn = pysftp.Connection(site.sftp_host, username=site.sftp_username, password=site.sftp_password, port=7822, cnopts=cnopts)
+			conn.chdir(site.sftp_path) # using default_path arg to constructor doesn't report errors
+			return conn
+		site.sftp = UploadQueue(connect)
 		try:
-			sftp.put(path)
+			site.sftp.check()
 		except Exception as err:
-			messagebox.showerror("FTP Put Error", err)
+			error(site, "FTP Connection Error", err)
+			site.sftp.close()
+			site.sftp = None
 		else:
-			num_successful = num_successful + 1
+			status(f'Connected to {site.sftp_host} at {site.sftp_path}')
+
+def sftp_put(site, path):
+	if site.sftp:
+		# files in subfolders of the output go to the same subfolder on the server
+		rel = os.path.relpath(path, site.out_path(''))
+		site.sftp.put(path, None if rel.startswith(os.pardir) else rel.replace(os.sep, '/'))
+
+# Uploads run in the background while pages are being built. Files are queued by
+# sftp_put() and uploaded by a few worker threads, each keeping its own connection open
+# between files and builds. A failed upload is retried with a new connection; the result
+# for each file is collected by wait() at the end of the build.
+UPLOAD_WORKERS = 3
+UPLOAD_QUEUE_SIZE = 100
+UPLOAD_RETRIES = 3
+UPLOAD_RETRY_DELAY = 1 # seconds, doubled for each retry
+
+class UploadQueue:
+	def __init__(self, connect, workers = UPLOAD_WORKERS, retries = UPLOAD_RETRIES):
+		self.connect = connect # returns a connection with put(path, remotepath), makedirs(folder) and close()
+		self.retries = retries
+		self.queue = queue.Queue(UPLOAD_QUEUE_SIZE)
+		self.lock = threading.Lock()
+		self.idle = [] # connections not yet taken by a worker
+		self.queued = set()
+		self.folders = set() # remote folders known to exist
+		self.results = {} # path -> None if uploaded, otherwise the error
+		self.threads = [threading.Thread(target=self.work, daemon=True) for i in range(workers)]
+		for t in self.threads:
+			t.start()
+
+	# Makes a connection, so that bad settings are reported right away.
+	def check(self):
+		conn = self.connect()
+		with self.lock:
+			self.idle.append(conn)
+
+	# remote is the path on the server, relative to the upload folder; by default the
+	# file goes in the upload folder itself.
+	def put(self, path, remote = None):
+		with self.lock:
+			if path in self.queued:
+				return
+			self.queued.add(path)
+		self.queue.put((path, remote))
+
+	def work(self):
+		conn = None
+		while True:
+			item = self.queue.get()
+			if item is None:
+				break
+			(path, remote) = item
+			folder = (remote or '').rpartition('/')[0]
+			with self.lock:
+				self.queued.discard(path)
+			err = None
+			for attempt in range(self.retries + 1):
+				try:
+					if not conn:
+						with self.lock:
+							if self.idle:
+								conn = self.idle.pop()
+						if not conn:
+							conn = self.connect()
+					if folder and folder not in self.folders:
+						conn.makedirs(folder)
+						with self.lock:
+							self.folders.add(folder)
+					conn.put(path, remote)
+					err = None
+					break
+				except Exception as e:
+					err = e
+					close_connection(conn)
+					conn = None
+					if attempt < self.retries:
+						time.sleep(UPLOAD_RETRY_DELAY * 2 ** attempt)
+			with self.lock:
+				self.results[path] = err
+			self.queue.task_done()
+		close_connection(conn)
+		self.queue.task_done()
+
+	def wait(self):
+		self.queue.join()
+		with self.lock:
+			results = self.results
+			self.results = {}
+		return results
+
+	def close(self):
+		for t in self.threads:
+			self.queue.put(None)
+		for t in self.threads:
+			t.join()
+		for conn in self.idle:
+			close_connection(conn)
+
+def close_connection(conn):
+	try:
+		if conn:
+			conn.close()
+	except Exception:
+		pass
 
 def split_at_word(s, n):
 	r = ''
@@ -444,59 +1594,62 @@ def split_at_word(s, n):
 			n = 2 * n + 4
 	return r.strip()
 
-def process_menu():
-	global menu_list
-
+# Returns True if the order of the pages in the menu changed.
+def process_menu(site, write = True):
+	old_menu_list = site.menu_list
 	menu_list = []
 	html = ''
 	have_menu = False
 	try:
-		with open(text_path('@menu'), 'r') as fm:
-			for p in fm:
-				p = p.strip()
-				if len(p) == 0:
-					continue
-				if p[0] == '@':
+		for info in site.pages.values():
+			info.menu_pos = -1
+		for p in page_text(site, '@menu').splitlines():
+			p = p.strip()
+			if len(p) == 0:
+				continue
+			if p[0] == '@':
+				continue
+			if p[0] == '<':
+				html += p + '\n'
+			else:
+				menu_list.append(p)
+				if p not in site.pages:
+					raise FileNotFoundError(f'No page "{p}"')
+				info = site.pages[p]
+				info.menu_pos = len(menu_list) - 1
+				title = info.title
+				if title == '':
 					continue
-				if p[0] == '<':
-					html += p + '\n'
-				else:
-					menu_list.append(p)
-					path = text_path(p)
-					s = None
-					with open(path, 'r') as f:
-						s = f.read()
-					if not s:
-						s = p
-					(title, t) = extract_title(s)
-					if title == '':
-						continue
-					file = html_file(p)
-					t = split_at_word(title, 40)
-					html += f'<p id="m-{p}"><a href="{file}">{t}</a>\n'
-				have_menu = True
-		if have_menu:
-			path = html_path('menu')
-			with open(path, 'w') as out:
-				out.write(html + '\n')
-			sftp_put(path)
+				file = html_file(p)
+				t = split_at_word(title, 40)
+				html += f'<p id="m-{p}"><a href="{file}">{t}</a>\n'
+			have_menu = True
+		site.menu_list = menu_list
+		if have_menu and write:
+			path = html_path(site, 'menu')
+			html += '\n'
+			if site.minify:
+				html = minify(site, 'menu.html', html, 'html')
+			if write_file(site, path, html):
+				sftp_put(site, path)
 	except Exception as err:
-		messagebox.showerror("Error", '@menu page error: ' + str(err))
+		error(site, "Error", '@menu page error: ' + str(err))
+	return site.menu_list != old_menu_list
 
-def has_content(page):
-	with open(text_path(page), 'r') as f:
-		s = f.read().strip()
-	return len(s) > 0
+def has_content(site, page):
+	return len(page_text(site, page).strip()) > 0
 
-def build_menu(expand = True):
-	with open(text_path('@menu'), 'r') as f:
-		m = f.read().strip()
+def build_menu(site, expand = True):
+	m = page_text(site, '@menu').strip()
 	if len(m) == 0:
 		return None;
+	if site.shared_menu:
+		return '''<div id=menu class=topnav data-src="menu.html"></div>
+'''
 	html = '''<div id=menu class=topnav>
 '''
 	if (expand):
-		html += get_pages_file('menu')
+		html += get_pages_file(site, 'menu')
 	else:
 		html += '\n<!--#include file="menu.shtml" -->\n'
 	html += f'''
@@ -504,52 +1657,101 @@ def build_menu(expand = True):
 '''
 	return html
 
-def extract_title(s):
-	(params, rest) = get_params(s)
-	if 'title' in params:
-		title = params['title']
-	else:
-		title = ''
-	return(title, rest)
-
-def get_params(s):
+# Returns the @name value lines at the top of a page (title is always present) and where
+# the rest of the page starts.
+def parse_params(s):
 	params = {}
-	s = s.strip()
+	i = 0
+	n = len(s)
 	while True:
-		m = re.match('(?s)^@(\w*)([^\n]*)(.*)', s)
-		if not m:
+		while i < n and s[i].isspace():
+			i += 1
+		if i >= n or s[i] != '@':
 			break
+		m = param_re.match(s, i)
 		params[m.group(1)] = m.group(2).strip()
-		s = m.group(3).strip()
+		i = m.end()
 	if not 'title' in params:
 		params['title'] = ''
-	return (params, s)
-
-def get_pages_file(f):
+	return (params, i)
+
+param_re = re.compile(r'@(\w*)([^\n]*)')
+page_link_text_re = re.compile(r'\{([^{}]*)\|([^}]*)\}')
+command_re = re.compile('^%%([^ ]*) *([^ ]*) *([^ ]*) *([^ ]*)$')
+
+# Parses a page in one pass into an intermediate representation that's cached by the
+# hash of the text in Site.parse_cache, so unchanged pages aren't parsed again:
+#   params  dict of @name value lines at the top of the page (title is always present)
+#   blocks  ('text', markdown), ('cell', class, href), ('image', src, class, width), ('clear',)
+def parse_page(site, s):
+	key = hashlib.sha1(s.encode()).hexdigest()
+	ir = site.parse_cache.get(key)
+	if ir:
+		return ir
+	(params, i) = parse_params(s)
+	body = s[i:].strip()
+	mtext = page_link_text_re.sub(r'<a href="\1.html">\2</a>', body)
+	blocks = []
+	t = ''
+	for line in mtext.splitlines():
+		if line.startswith('%%'):
+			m = command_re.match(line)
+			if m:
+				match m.group(1):
+					case 'cell':
+						blocks.append(('text', t))
+						blocks.append(('cell', m.group(2), m.group(3)))
+						t = ''
+					case 'image':
+						blocks.append(('text', t))
+						blocks.append(('image', m.group(2), m.group(3), m.group(4)))
+						t = ''
+					case 'clear':
+						blocks.append(('text', t))
+						blocks.append(('clear',))
+						t = ''
+				continue
+		if line.startswith('https:'):
+			t += f'\n<p style="margin-left: 20px;"><a href="{line}" target=_blank>{line}</a></p>\n'
+		else:
+			t = t + line + '\n'
+	blocks.append(('text', t))
+	ir = {'params': params, 'blocks': blocks}
+	size = sys.getsizeof(ir) + sum(sys.getsizeof(x) for b in blocks for x in b)
+	size += sum(sys.getsizeof(k) + sys.getsizeof(v) for (k, v) in params.items())
+	site.parse_cache.put(key, ir, size)
+	trim_caches(site)
+	return ir
+
+def get_pages_file(site, f):
 	if (f == 'site.css'):
-		path = os.path.join(PAGES_FOLDER, 'site.css')
+		path = site.out_path('site.css')
 	else:
-		path = html_path(f)
+		path = html_path(site, f)
 	return Path(path).read_text()
 
-def build_html(page, s, prev_link, next_link, expand = True):
-	(params, mtext) = get_params(s)
+def build_html(site, page, s, prev_link, next_link, expand = True):
+	ir = parse_page(site, s)
+	params = ir['params']
 	title = params['title']
 	nomenu = 'nomenu' in params
 	colors = 'colors' in params
 	masonry = 'masonry' in params
+	# with @cellchunk N, only the first N cells are in the page and the rest are loaded
+	# N at a time from separate files as the reader scrolls down
+	try:
+		cellchunk = int(params.get('cellchunk') or 0)
+	except ValueError:
+		cellchunk = -1
+	if cellchunk < 0:
+		error(site, page, 'Expected "@cellchunk N" with a whole number N above 0; all the cells are put in the page')
+		cellchunk = 0
 	if masonry:
 		masonry_options = params['masonry']
 	else:
 		masonry_options = ''
-	while True:
-		mm = re.match('(?s)^(.*)\{([^}]*)\|([^}]*)\}(.*)$', mtext)
-		if not mm:
-			break
-		mtext = mm.group(1) + f'<a href="{mm.group(2)}.html">{mm.group(3)}</a>' + mm.group(4)
-	sidebar = build_menu(expand)
+	sidebar = build_menu(site, expand)
 	want_table = sidebar and not nomenu
-	epoch_time = str(time.time())
 	html1 = f'''<!DOCTYPE html>
 <html lang="en">
 <head>
@@ -557,6 +1759,11 @@ def build_html(page, s, prev_link, next_link, expand = True):
 <meta name="viewport" content="width=device-width, initial-scale=1" />
 <title>{title}</title>
 '''
+	# let the browser fetch the pages a reader is likely to go to next while this one is read
+	(prev_nav, next_nav) = nav_links(site, page)
+	hints = [l for l in (next_nav, prev_nav, None if page == HOME_PAGE else html_file(HOME_PAGE)) if l]
+	for link in dict.fromkeys(hints):
+		html1 += f'<link rel="prefetch" href="{link}">\n'
 	if masonry:
 		html1 += '''
 <script type="text/javascript" src="masonry.pkgd.min.js"></script>
@@ -671,7 +1878,7 @@ img.right {{
 	}
 '''
 	if (expand):
-		html1 += get_pages_file('site.css')
+		html1 += get_pages_file(site, 'site.css')
 	else:
 		html1 += '\n<!--#include file="site.css" -->\n'
 	html1 += f'''
@@ -702,22 +1909,18 @@ function toggleMobileMenu() {{
 }}
 function setcolors() {{
 	let x = [0, 90, 180, 270, 30, 120, 210, 300, 60, 150, 240, 330];
-	for (let id = 1; id <= 100; id++) {{
-		let hsl = "hsl(" + x[(id - 1) % 12] + " 100% 90%)";
-		let p = document.getElementById('cell' + id);
-		if (p) {{
-			p.style.backgroundColor = hsl;
-			p.style.display = 'block';
-		}}
-		else
-			break;
+	for (let p of document.querySelectorAll('.grid-item[id^="cell"]')) {{
+		let id = parseInt(p.id.substring(4));
+		p.style.backgroundColor = "hsl(" + x[(id - 1) % 12] + " 100% 90%)";
+		p.style.display = 'block';
 	}}
 }}
+let msnry = null;
 function bodyloadedmasonry() {{
 	let grid = document.querySelector('.grid');
 	imagesLoaded(grid,
 		function () {{
-			let msnry = new Masonry(grid,
+			msnry = new Masonry(grid,
 				{{
 					// options
 					itemSelector: '.grid-item',
@@ -737,10 +1940,63 @@ function bodyloadedmasonry() {{
 		celldisplay = 'block'
 	html1 += f'''
 	bodyloaded();
-}}
+}}'''
+	if cellchunk:
+		# appends the next fragment of cells to the grid whenever the end of the grid is in view
+		html1 += f'''
+function loadcells() {{
+	let more = document.getElementById('more-cells');
+	let grid = document.querySelector('.grid');
+	if (!more || !grid)
+		return;
+	let srcs = more.dataset.src.split(' ');
+	let showlinks = () => {{ more.innerHTML = srcs.map(s => '<a href="' + s + '">' + s + '</a>').join(' '); }};
+	if (!('IntersectionObserver' in window))
+		return showlinks();
+	let observer = new IntersectionObserver(entries => {{
+		if (!entries[entries.length - 1].isIntersecting || more.dataset.loading)
+			return;
+		more.dataset.loading = 'yes';
+		fetch(srcs[0])
+			.then(r => r.ok ? r.text() : Promise.reject())
+			.then(t => {{
+				let tmp = document.createElement('div');
+				tmp.innerHTML = t;
+				let items = Array.from(tmp.children);
+				grid.append(...items);
+				{'setcolors();' if colors else ''}
+				if (msnry) {{
+					msnry.appended(items);
+					imagesLoaded(grid, () => msnry.layout());
+				}}
+				srcs.shift();
+				delete more.dataset.loading;
+				observer.unobserve(more);
+				if (srcs.length)
+					observer.observe(more);
+				else
+					more.remove();
+			}})
+			.catch(() => {{ observer.disconnect(); showlinks(); }});
+	}}, {{rootMargin: '1000px'}});
+	observer.observe(more);
+}}'''
+	html1 += f'''
 function bodyloaded() {{
 	let m = document.getElementById("menu");
-	let ph = document.getElementById("page-header");
+'''
+	if site.shared_menu:
+		html1 += '''	if (m && m.dataset.src) {
+		let url = m.dataset.src;
+		delete m.dataset.src;
+		fetch(url, {cache: 'no-cache'})
+			.then(r => r.ok ? r.text() : Promise.reject())
+			.then(t => { m.innerHTML = t; bodyloaded(); })
+			.catch(() => { m.innerHTML = '<p><a href="' + url + '">Menu</a>'; });
+		return;
+	}
+'''
+	html1 += f'''	let ph = document.getElementById("page-header");
 	let mi =  document.getElementById("m-{page}");
 	if (m && ph && mi) {{
 		let rect = ph.getBoundingClientRect();
@@ -755,10 +2011,10 @@ function bodyloaded() {{
 }}
 </script>
 </head>'''
-	if masonry:
-		html1 += '\n<body onload="bodyloadedmasonry()">'
-	else:
-		html1 += '\n<body onload="bodyloaded()">'
+	onload = 'bodyloadedmasonry()' if masonry else 'bodyloaded()'
+	if cellchunk:
+		onload += '; loadcells()'
+	html1 += f'\n<body onload="{onload}">'
 	html1 += f'''
 <div id="hamburger-icon" onclick="toggleMobileMenu()">
 	<div class="bar1"></div>
@@ -768,12 +2024,12 @@ function bodyloaded() {{
 <div id="hamburger-icon-x" onclick="toggleMobileMenu()">
 	X
 </div>'''
-	if has_content('@header'):
+	if has_content(site, '@header'):
 		html1 += '''
 <div id=page-header>
 '''
 	if (expand):
-		html1 += get_pages_file('header')
+		html1 += get_pages_file(site, 'header')
 	else:
 		html1 += '\n<!--#include file="header.shtml" -->\n'
 	html1 += f'''
@@ -809,13 +2065,13 @@ function bodyloaded() {{
 		html2 = '</div></td></tr></table>'
 	else:
 		html2 = '</div>'
-	if has_content('@footer'):
+	if has_content(site, '@footer'):
 		html2 += '''
 <hr id=footer-hr>
 <div id=page-footer>
 '''
 	if (expand):
-		html2 += get_pages_file('footer')
+		html2 += get_pages_file(site, 'footer')
 	else:
 		html2 += '\n<!--#include file="footer.shtml" -->\n'
 	html2 += f'''
@@ -824,61 +2080,135 @@ function bodyloaded() {{
 </body>
 </html>
 '''
-	mtext = process_commands(mtext, celldisplay)
-	return html1 + mtext + html2
-
-def process_commands(mtext, celldisplay):
+	(mtext, cells) = process_commands(site, ir['blocks'], celldisplay)
+	record_links(site, page, mtext, prev_nav, next_nav)
+	fragments = []
+	if cellchunk and len(cells) > cellchunk + 1:
+		# cells[i] is where cell i starts in mtext, and the last entry is where the last one ends
+		for i in range(cellchunk, len(cells) - 1, cellchunk):
+			fragments.append(mtext[cells[i]:cells[min(i + cellchunk, len(cells) - 1)]])
+		srcs = ' '.join(html_file(f'{page}.cells{k + 1}') for k in range(len(fragments)))
+		mtext = mtext[:cells[cellchunk]] + mtext[cells[-1]:] + f'<div id=more-cells data-src="{srcs}"></div>\n'
+	return (html1 + mtext + html2, fragments)
+
+# Returns the HTML for the blocks of a page, and the positions in it where each cell
+# starts, followed by where the last cell ends.
+def process_commands(site, blocks, celldisplay):
 	first_cell = True
 	had_cell = False
 	close_anchor = False
 	html = ''
-	t = ''
 	idnum = 1
-	for s in mtext.splitlines():
-		m = re.match('^%%([^ ]*) *([^ ]*) *([^ ]*) *([^ ]*)$', s)
-		anchor = re.match('^https:.*$', s)
-		if m:
-			arg1 = m.group(2)
-			arg2 = m.group(3)
-			arg3 = m.group(4)
-			match m.group(1):
-				case 'cell':
-					html += markdown.markdown(t)
-					t = ''
-					if first_cell:
-						html += '<div class=grid>\n'
-						had_cell = True
-						first_cell = False;
-					else:
-						html += '</div>\n'
-						if close_anchor:
-							html += '</a>\n'
-							close_anchor = False
-					if len(arg2) > 0:
-						html += f'<a class="cell-anchor" href="{arg2}">\n'
-						close_anchor = True
-					html += f'<div id=cell{idnum} class="grid-item {arg1}" style="display: {celldisplay};">\n'
-					idnum += 1
-				case 'image':
-					html += markdown.markdown(t)
-					t = ''
-					if len(arg3) > 0:
-						w = f' style="max-width:{arg3}px;"'
-					else:
-						w = ''
-					html += f'\n<img src="{arg1}" class="{arg2}" {w}>\n'
-				case 'clear':
-					html += markdown.markdown(t)
-					t = ''
-					html += '\n<br clear=all>\n'
-		elif anchor:
-			t += f'\n<p style="margin-left: 20px;"><a href="{anchor.group(0)}" target=_blank>{anchor.group(0)}</a></p>\n'
-		else:
-			t = t + s + '\n'
-	html += markdown.markdown(t)
+	cells = []
+	for b in blocks:
+		match b[0]:
+			case 'text':
+				html += markdown_to_html(site, b[1])
+			case 'cell':
+				(arg1, arg2) = b[1:]
+				if first_cell:
+					html += '<div class=grid>\n'
+					had_cell = True
+					first_cell = False;
+				else:
+					html += '</div>\n'
+					if close_anchor:
+						html += '</a>\n'
+						close_anchor = False
+				cells.append(len(html))
+				if len(arg2) > 0:
+					html += f'<a class="cell-anchor" href="{arg2}">\n'
+					close_anchor = True
+				html += f'<div id=cell{idnum} class="grid-item {arg1}" style="display: {celldisplay};">\n'
+				idnum += 1
+			case 'image':
+				(arg1, arg2, arg3) = b[1:]
+				if len(arg3) > 0:
+					w = f' style="max-width:{arg3}px;"'
+				else:
+					w = ''
+				html += f'\n<img src="{arg1}" class="{arg2}" {w}>\n'
+			case 'clear':
+				html += '\n<br clear=all>\n'
 	if had_cell:
-		html += '</div></div>\n'
-	return html
+		html += '</div>'
+		cells.append(len(html))
+		html += '</div>\n'
+	return (html, cells)
+
+# With @minify, generated HTML, CSS, and JavaScript are made smaller without changing
+# what they do: comments and extra whitespace are removed, except in <pre> and <textarea>,
+# in strings, and in server-side includes. Results are cached by the hash of the input,
+# in Site.minify_cache.
+raw_element_re = re.compile(r'(<(pre|textarea|script|style)\b[^>]*>)(.*?)(</\2\s*>)', re.I | re.S)
+html_comment_re = re.compile(r'<!--(?![#\[]).*?-->', re.S)
+css_string_or_comment_re = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|/\*.*?\*/''', re.S)
+js_string_or_comment_re = re.compile(r'''("(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`)|/\*.*?\*/''', re.S)
+
+def minify(site, name, s, kind):
+	key = (kind, hashlib.sha1(s.encode()).hexdigest())
+	m = site.minify_cache.get(key)
+	if m is None:
+		match kind:
+			case 'html':
+				m = minify_html(s)
+			case 'css':
+				m = minify_css(s)
+		if len(m.encode()) > len(s.encode()):
+			m = s
+		site.minify_cache.put(key, m, sys.getsizeof(m))
+		trim_caches(site)
+	saved = len(s.encode()) - len(m.encode())
+	site.bytes_saved += saved
+	site.build_report.append(f'Minified {name}: {saved} bytes saved')
+	return m
+
+def minify_html(s):
+	out = []
+	pos = 0
+	for m in raw_element_re.finditer(s):
+		out.append(collapse_html(s[pos:m.start()]))
+		match m.group(2).lower():
+			case 'script':
+				body = minify_js(m.group(3))
+			case 'style':
+				body = minify_css(m.group(3))
+			case _:
+				body = m.group(3)
+		out.append(m.group(1) + body + m.group(4))
+		pos = m.end()
+	out.append(collapse_html(s[pos:]))
+	# a trailing newline is kept only if there was one, so small fragments don't grow
+	return ''.join(out).strip() + ('\n' if s.endswith('\n') else '')
+
+def collapse_html(s):
+	s = html_comment_re.sub('', s)
+	s = re.sub(r'[ \t]*\n\s*', '\n', s)
+	return re.sub(r'[ \t]+', ' ', s)
+
+def minify_css(s):
+	s = css_string_or_comment_re.sub(lambda m: m.group(1) or '', s)
+	parts = css_string_or_comment_re.split(s)
+	for i in range(0, len(parts), 2): # strings are at odd indexes
+		if parts[i]:
+			t = re.sub(r'\s+', ' ', parts[i])
+			t = re.sub(r' ?([{};,]) ?', r'\1', t).replace(': ', ':')
+			parts[i] = t.replace(';}', '}')
+	return ''.join(p or '' for p in parts).strip()
+
+# Only whole-line // comments are removed, and lines are kept, so automatic semicolon
+# insertion still works. Template literals can span lines, so scripts with them only
+# lose their /* */ comments.
+def minify_js(s):
+	s = js_string_or_comment_re.sub(lambda m: m.group(1) or '', s)
+	if '`' in s:
+		return s
+	lines = []
+	for line in s.splitlines():
+		line = line.strip()
+		if len(line) > 0 and not line.startswith('//'):
+			lines.append(line)
+	return '\n'.join(lines)
 
 # Following were once used, but no longer. Code is here in case it's found to be useful someday.
 
@@ -908,17 +2238,17 @@ def process_commands(mtext, celldisplay):
 # 		webbrowser.open_new(html_file)
 
 def sync_site():
-	if not site_folder:
+	if not site:
 		messagebox.showerror("Error", "No site is open.")
 		return
 	save_current_page()
 	try:
 		if platform.system() == 'Windows':
-			cmd = r'data\sync.bat'
+			cmd = site.data_path('sync.bat')
 		else:
-			cmd = r'data\sync'
+			cmd = site.data_path('sync')
 		if os.path.isfile(cmd):
-			result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+			result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=site.folder)
 			messagebox.showinfo('Sync', result.stdout)
 		else:
 			messagebox.showerror('File Missing', f"To use Sync, create a {cmd} file.")
@@ -929,66 +2259,193 @@ def rebuild_all():
 	rebuild_site(True)
 
 def rebuild_site(expand = True):
-	global num_successful
-
-	if not site_folder:
+	if not site:
 		messagebox.showerror("Error", "No site is open.")
 		return
-	num_successful = 0;
-	num_expected = len(pages) + 1 # settings not uploaded; two js files are
 	save_current_page()
-	for p in pages:
-		if p != '@settings' and p[0] == '@':
-			save_html_page(p, expand)
-	for p in pages:
-		if p[0] != '@':
-			save_html_page(p, expand)
-	process_fixed_files()
-	if sftp:
-		if num_successful == num_expected:
-			status(f'Uploaded OK ({num_successful} pages)')
+	num_missing = build_site(site, expand)
+	if site.sftp:
+		if site.num_successful == site.num_attempted:
+			status(f'Uploaded OK ({site.num_successful} files)')
+		else:
+			status(f'ERROR: Uploaded {site.num_successful} of {site.num_attempted} files')
+	elif num_missing > 0:
+		status(f'Rebuilt ({num_missing} missing assets, see {site.data_path(REPORT_FILE)})')
+	else:
+		status(f'Rebuilt ({len(site.changed)} files changed)')
+
+def build_site(site, expand = True):
+	refresh_pages(site)
+	begin_build(site)
+	try:
+		# the pages refer to the fixed files, so they have to be in place first
+		process_fixed_files(site)
+		for p in site.pages:
+			if p != '@settings' and p[0] == '@':
+				save_html_page(site, p, expand)
+		for p in site.pages:
+			if p[0] != '@':
+				save_html_page(site, p, expand)
+	except Exception:
+		abort_build(site)
+		raise
+	return end_build(site)
+
+# Builds one site without the GUI; used by build_sites() in worker processes.
+def build_folder(folder, expand = True):
+	site = Site(folder)
+	try:
+		load_site(site)
+		build_site(site, expand)
+	except Exception as err:
+		error(site, 'Build Error', err)
+		return (site.folder, False, site.build_report)
+	finally:
+		if site.sftp:
+			site.sftp.close()
+		close_store(site)
+	return (site.folder, site.num_successful == site.num_attempted and not site.budget_failures, site.build_report)
+
+def build_sites(folders, jobs = None):
+	ok = True
+	if len(folders) == 1:
+		results = [build_folder(folders[0])]
+	else:
+		with ProcessPoolExecutor(max_workers=jobs) as pool:
+			results = list(pool.map(build_folder, folders))
+	for (folder, success, report) in results:
+		if success:
+			print(f'Built {folder}')
 		else:
-			status(f'ERROR: Uploaded {num_successful} of {num_expected} pages')
+			print(f'FAILED {folder}')
+			ok = False
+		for s in report:
+			print('\t' + s)
+	return ok
+
+# The files that make up the published site, as (path in site, file) pairs: the pages,
+# header, footer and menu, site.css, the fixed JavaScript files and the assets the pages
+# use. Sources in DATA_FOLDER and anything else in the pages folder are left out.
+def publish_list(site):
+	current = os.path.join(site.folder, CURRENT_LINK)
+	if site.releases and os.path.isdir(current):
+		return [(rel, os.path.join(current, rel)) for rel in sorted(read_release_manifest(current))]
+	names = [html_file(p) for p in site.pages if p[0] != '@']
+	for name in os.listdir(site.out_path('')):
+		m = re.match(r'(.*)\.cells\d+\.html$', name)
+		if m and m.group(1) in site.pages:
+			names.append(name)
+	names += [html_file('header'), html_file('footer'), html_file('menu'), 'site.css', 'sitemap.xml'] + FIXED_FILES
+	for (rel, entry) in site.asset_manifest.items():
+		if site.fingerprint and rel not in FIXED_FILES:
+			(stem, ext) = os.path.splitext(rel)
+			rel = f'{stem}.{entry[0][:10]}{ext}'
+		names.append(rel)
+	files = []
+	for rel in sorted(set(names)):
+		path = site.out_path(rel)
+		if os.path.isfile(path):
+			files.append((rel, path))
+	return files
+
+# Writes the published files of a site straight into a .tar.gz or .zip file (or a .tar.gz
+# stream on stdout if output is -), with a BUNDLE_MANIFEST listing the hash and size of
+# every file. With since (a previous bundle or its manifest) only the files that changed
+# are included; the manifest still lists them all, so it can be used for the next delta.
+BUNDLE_MANIFEST = 'bundle.manifest'
+
+def bundle_site(folder, output, since = None):
+	site = Site(folder)
+	try:
+		load_site(site)
+	finally:
+		if site.sftp:
+			site.sftp.close()
+		close_store(site)
+	old = read_bundle_manifest(since) if since else {}
+	published = publish_list(site)
+	files = []
+	manifest = ''
+	for (rel, path) in published:
+		h = file_hash(path)
+		manifest += f'{h} {os.path.getsize(path)} {rel}\n'
+		if old.get(rel) != h:
+			files.append((rel, path))
+	manifest = manifest.encode()
+	if output.endswith('.zip'):
+		with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as z:
+			z.writestr(BUNDLE_MANIFEST, manifest)
+			for (rel, path) in files:
+				z.write(path, rel)
 	else:
-		status('Rebuilt')
+		if output == '-':
+			tar = tarfile.open(fileobj=sys.stdout.buffer, mode='w|gz')
+		else:
+			tar = tarfile.open(output, 'w:gz')
+		with tar:
+			info = tarfile.TarInfo(BUNDLE_MANIFEST)
+			info.size = len(manifest)
+			info.mtime = time.time()
+			tar.addfile(info, io.BytesIO(manifest))
+			for (rel, path) in files:
+				tar.add(path, rel)
+	removed = len(set(old) - set(rel for (rel, path) in published))
+	print(f'Bundled {len(files)} of {len(published)} files' + (f', {removed} removed since the previous bundle' if removed else ''), file=sys.stderr)
+	return True
+
+def read_bundle_manifest(path):
+	if tarfile.is_tarfile(path):
+		with tarfile.open(path) as tar:
+			data = tar.extractfile(BUNDLE_MANIFEST).read()
+	elif zipfile.is_zipfile(path):
+		with zipfile.ZipFile(path) as z:
+			data = z.read(BUNDLE_MANIFEST)
+	else:
+		with open(path, 'rb') as f:
+			data = f.read()
+	hashes = {}
+	for s in data.decode().splitlines():
+		(h, size, rel) = s.split(' ', 2)
+		hashes[rel] = h
+	return hashes
 
 def new_page():
-	if not site_folder:
+	if not site:
 		messagebox.showerror("Error", 'No site is open.')
 		return
 	save_current_page()
 	page = askstring('New Page', 'Tag (not title) for new page')
-	path = text_path(page)
-	if os.path.exists(path):
+	if not page:
+		return
+	if page_exists(site, page):
 		messagebox.showerror("Error", 'Page already exists.')
 		return
-	text = f'@title Page {page}\nRest of page'
-	with open(path, 'w') as f:
-		f.write(text)
-	sftp_put(path)
-	write_html(page, text)
-	pages.append(page)
-	populate_pages_listbox()
-	index = pagelistbox.get(0, "end").index(page)
-	pagelistbox.selection_set(index)
-	select_page()
-	menu_path = text_path('@menu')
-	# read all the lines to get rid of blank ones
-	with open(menu_path, 'r') as f:
-		menu = f.readlines()
-	with open(menu_path, 'w') as f:
-		for p in menu:
-			p = p.strip()
-			if len(p) == 0:
-				continue
-			f.write(p + '\n')
-		f.write(page + '\n')
-	process_menu()
-
-pages = []
+	begin_build(site)
+	try:
+		text = f'@title Page {page}\nRest of page'
+		write_page_source(site, page, text, False)
+		if not site.db:
+			sftp_put(site, text_path(site, page))
+		write_html(site, page, text)
+		add_page(site, page)
+		page_filter.set('') # shows all the pages, including the new one
+		index = pagelistbox.get(0, "end").index(page)
+		pagelistbox.selection_set(index)
+		select_page()
+		# get rid of blank lines
+		menu = [p.strip() for p in read_page_source(site, '@menu').splitlines()]
+		write_page_source(site, '@menu', ''.join(p + '\n' for p in menu if p) + page + '\n', False)
+		add_page(site, '@menu')
+		if process_menu(site):
+			rerender_prevnext_changes(site)
+	except Exception:
+		abort_build(site)
+		raise
+	end_build(site)
 
 def on_closing():
 	save_current_page()
+	close_site()
 	root.destroy()
 
 def on_changed(event=None):
@@ -1006,57 +2463,320 @@ def reset_changed():
 def control_s(e):
 	save_current_page()
 
-root = Tk()
-root.title("StaticSiteBuilder")
-root.protocol("WM_DELETE_WINDOW", on_closing)
-root.columnconfigure(1, weight=1)
-root.rowconfigure(0, weight=1)
-
-leftframe = ttk.Frame(root, width=36)
-leftframe.columnconfigure(1, weight=1)
-leftframe.rowconfigure(2, weight=1)
-leftframe.grid(column=0, row=0, sticky="nsw")
-
-rightframe = ttk.Frame(root)
-rightframe.columnconfigure(3, weight=1)
-rightframe.rowconfigure(1, weight=1)
-rightframe.grid(column=1, row=0, sticky="nsew")
-
-ttk.Button(leftframe, text="Open Site", command=open_site).grid(column=0, row=0)
-ttk.Button(leftframe, text="New Site", command=new_site).grid(column=1, row=0)
-ttk.Label(leftframe, text="Pages").grid(column=0, columnspan=2, row=1)
-pagelistbox = Listbox(leftframe, width=30, activestyle='none')
-pagelistbox.bind('<Double-Button>', select_page)
-pagelistbox.grid(column=0, row=2, columnspan=4, sticky="nsew")
-ttk.Button(leftframe, text="Select Page", command=select_page).grid(column=0, row=3)
-ttk.Button(leftframe, text="New Page", command=new_page).grid(column=1, row=3)
-populate_pages_listbox()
-
-content_label = ttk.Label(rightframe, text="Content")
-content_label.grid(column=0, row=0, columnspan=4)
-pagetext = scrolledtext.ScrolledText(rightframe, undo=True, wrap=WORD)
-pagetext.bind("<<Modified>>", on_changed)
-pagetext.grid(column=0, row=1, columnspan=4, sticky='nsew')
-ttk.Button(rightframe, text="Save Page", command=save_current_page).grid(column=0, row=2)
-ttk.Button(rightframe, text="Rebuild All", command=rebuild_all).grid(column=1, row=2)
-ttk.Button(rightframe, text="Sync", command=sync_site).grid(column=2, row=2)
-status_label = ttk.Label(rightframe, text='')
-status_label.grid(column=3, row=2, sticky='w')
-
-if output_display:
-	xtext = scrolledtext.ScrolledText(rightframe, undo=True, wrap=WORD)
-	xtext.grid(column=4, row=0, columnspan=1, rowspan=3, sticky='nsew')
-
-
-for child in leftframe.winfo_children(): 
-    child.grid_configure(padx=5, pady=5)
-for child in rightframe.winfo_children(): 
-    child.grid_configure(padx=5, pady=5)
-
-w = root.winfo_screenwidth()
-h = root.winfo_screenheight()
-root.geometry(str(int(.5 * w)) + 'x' + str(int(.6 * h)) + "+100+100")
-root.minsize(1000, 500) # width was 600
-root.bind('<Control-s>', control_s)
-
-root.mainloop()
\ No newline at end of file
+# Renders the Markdown of every page of a site with each engine and reports how fast
+# each one is and which documents come out differently from the default engine. HTML
+# that differs only in whitespace between tags is treated as the same.
+def compare_markdown(folder, engines, max_diffs):
+	site = Site(folder)
+	open_store(site)
+	load_page_index(site)
+	refresh_pages(site)
+	docs = []
+	for page in site.pages:
+		text = page_text(site, page)
+		if page in ('@header', '@footer'):
+			docs.append((page, text))
+		elif not page.startswith('@'):
+			docs += [(page, b[1]) for b in parse_page(site, text)['blocks'] if b[0] == 'text']
+	size = sum(len(d[1].encode()) for d in docs)
+	print(f'{len(docs)} Markdown blocks, {size} bytes')
+	baseline = None
+	ok = True
+	for engine in [DEFAULT_MARKDOWN] + [e for e in engines if e != DEFAULT_MARKDOWN]:
+		try:
+			convert = markdown_converter(engine)
+		except (KeyError, ImportError) as err:
+			print(f'{engine}: not available ({err!r})')
+			ok = ok and engine in MARKDOWN_ENGINES
+			continue
+		start = time.perf_counter()
+		output = [convert(d[1]) for d in docs]
+		elapsed = max(time.perf_counter() - start, 1e-9)
+		if baseline is None:
+			baseline = output
+			print(f'{engine}: {elapsed:.3f}s, {size / elapsed / 1e6:.2f} MB/s (baseline)')
+			continue
+		differ = [i for i in range(len(docs)) if normalize_html(output[i]) != normalize_html(baseline[i])]
+		print(f'{engine}: {elapsed:.3f}s, {size / elapsed / 1e6:.2f} MB/s, {len(differ)} of {len(docs)} blocks differ')
+		for i in differ[:max_diffs]:
+			print(f'  {docs[i][0]}:')
+			for line in list(difflib.unified_diff(baseline[i].splitlines(), output[i].splitlines(), DEFAULT_MARKDOWN, engine, lineterm=''))[2:]:
+				print('    ' + line)
+	return ok
+
+def normalize_html(s):
+	return re.sub(r'>\s+<', '><', s.strip())
+
+# A build server keeps a site loaded, with its macros, parsed pages and minified output
+# cached, so an editor can have a page rendered right after saving it. It listens on a
+# Unix socket (data/BUILD_SOCKET by default) for requests, one JSON object per line, and
+# answers each with a line of JSON:
+#   {"command": "render", "page": TAG}  renders one page, after picking up changes to the
+#                                       @ pages (settings, macros, menu, header, ...)
+#   {"command": "rebuild"}              rebuilds the whole site
+#   {"command": "status"}               pages, cache sizes and builds so far
+#   {"command": "stop"}
+# Every answer has "ok", and "error" if it failed; builds also return the files changed
+# and the build report.
+BUILD_SOCKET = 'build.sock'
+
+class BuildServer(socketserver.UnixStreamServer):
+	def __init__(self, site, path):
+		self.site = site
+		self.started = time.time()
+		self.builds = 0
+		self.stopping = False
+		super().__init__(path, BuildRequestHandler)
+
+class BuildRequestHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		for line in self.rfile:
+			try:
+				reply = serve_request(self.server, json.loads(line))
+			except Exception as err:
+				reply = {'ok': False, 'error': str(err)}
+			self.wfile.write((json.dumps(reply) + '\n').encode())
+			self.wfile.flush()
+			if self.server.stopping:
+				threading.Thread(target=self.server.shutdown).start()
+				return
+
+# Re-reads the @ pages that were edited since the server loaded them; returns their tags.
+def refresh_special_pages(site):
+	changed = []
+	for p in [p for p in site.pages if p[0] == '@']:
+		h = site.pages[p].hash
+		check_page(site, p)
+		if site.pages[p].hash != h:
+			changed.append(p)
+	return changed
+
+def serve_request(server, request):
+	site = server.site
+	start = time.perf_counter()
+	match request.get('command'):
+		case 'render':
+			page = request.get('page', '')
+			if not page_exists(site, page):
+				return {'ok': False, 'error': f'No page {page}'}
+			begin_build(site)
+			try:
+				old_menu_list = site.menu_list
+				for p in refresh_special_pages(site):
+					if p != page:
+						save_html_page(site, p)
+				if page in site.pages:
+					check_page(site, page)
+				else:
+					add_page(site, page)
+				save_html_page(site, page)
+				process_menu(site) # in case title changed
+				if site.menu_list != old_menu_list:
+					rerender_prevnext_changes(site)
+			except Exception:
+				abort_build(site)
+				raise
+			end_build(site)
+		case 'rebuild':
+			# build_site() redoes the other @ pages itself, but not @settings
+			if '@settings' in refresh_special_pages(site):
+				process_settings(site)
+			build_site(site, request.get('expand', True))
+		case 'status':
+			return {
+				'ok': True,
+				'site': site.folder,
+				'pages': len(site.pages),
+				'cached_text_bytes': site.texts.bytes,
+				'parse_cache': len(site.parse_cache),
+				'parse_cache_bytes': site.parse_cache.bytes,
+				'minify_cache': len(site.minify_cache),
+				'minify_cache_bytes': site.minify_cache.bytes,
+				'builds': server.builds,
+				'uptime': round(time.time() - server.started, 1),
+			}
+		case 'stop':
+			server.stopping = True
+			return {'ok': True}
+		case command:
+			return {'ok': False, 'error': f'Unknown command {command}'}
+	server.builds += 1
+	return {
+		'ok': site.num_successful == site.num_attempted and not site.budget_failures,
+		'changed': site.changed,
+		'report': site.build_report,
+		'ms': round((time.perf_counter() - start) * 1000, 1),
+	}
+
+def serve_site(folder, path = None):
+	if not hasattr(socket, 'AF_UNIX'):
+		print('The build server needs Unix sockets', file=sys.stderr)
+		return False
+	site = Site(folder)
+	path = path or site.data_path(BUILD_SOCKET)
+	if os.path.exists(path):
+		try:
+			with socket.socket(socket.AF_UNIX) as s:
+				s.connect(path)
+			print(f'A build server is already listening on {path}', file=sys.stderr)
+			return False
+		except OSError:
+			os.remove(path) # left by a server that didn't exit cleanly
+	try:
+		load_site(site)
+		with BuildServer(site, path) as server:
+			status(f'Serving {site.folder} on {path}')
+			server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if site.sftp:
+			site.sftp.close()
+		close_store(site)
+		if os.path.exists(path):
+			os.remove(path)
+	return True
+
+# Sends one request to a build server and prints the answer.
+def build_client(folder, command, page = None, path = None):
+	path = path or Site(folder).data_path(BUILD_SOCKET)
+	request = {'command': command}
+	if page:
+		request['page'] = page
+	with socket.socket(socket.AF_UNIX) as s:
+		s.connect(path)
+		s.sendall((json.dumps(request) + '\n').encode())
+		reply = json.loads(s.makefile('r').readline())
+	print(json.dumps(reply, indent=1))
+	return reply.get('ok', False)
+
+# Without arguments the GUI is started. Sites can also be built from the command line:
+#   python build.py build [--jobs N] SITE_FOLDER...
+#   python build.py rollback SITE_FOLDER [RELEASE]
+#   python build.py mdcompare [--engines A,B] [--diffs N] SITE_FOLDER
+#   python build.py bundle [--since PREVIOUS] SITE_FOLDER OUTPUT
+#   python build.py import SITE_FOLDER
+#   python build.py export SITE_FOLDER
+#   python build.py serve [--socket PATH] SITE_FOLDER
+#   python build.py client [--socket PATH] SITE_FOLDER render|rebuild|status|stop [PAGE]
+def command_line(args):
+	parser = argparse.ArgumentParser(prog='build.py')
+	commands = parser.add_subparsers(dest='command', required=True)
+	p = commands.add_parser('build', help='rebuild one or more sites')
+	p.add_argument('--jobs', type=int, default=None, help='number of worker processes')
+	p.add_argument('folders', nargs='+')
+	p = commands.add_parser('rollback', help='switch a site with @releases back to an earlier release')
+	p.add_argument('folder')
+	p.add_argument('release', nargs='?')
+	p = commands.add_parser('mdcompare', help='compare the output and speed of the Markdown engines on a site')
+	p.add_argument('--engines', default=','.join(MARKDOWN_ENGINES), help='comma-separated engine names')
+	p.add_argument('--diffs', type=int, default=3, help='number of differences to show per engine')
+	p.add_argument('folder')
+	p = commands.add_parser('bundle', help='write the published files of a site to a .tar.gz or .zip file')
+	p.add_argument('--since', help='a previous bundle or manifest; only changed files are included')
+	p.add_argument('folder')
+	p.add_argument('output', help='.tar.gz or .zip file, or - for a .tar.gz on stdout')
+	p = commands.add_parser('import', help='copy the .txt pages of a site into data/site.db, which is used from then on')
+	p.add_argument('--prune', action='store_true', help='delete pages from the database that have no .txt file')
+	p.add_argument('--force', action='store_true', help='overwrite pages that were changed in the database after their .txt file')
+	p.add_argument('folder')
+	p = commands.add_parser('export', help='write the pages in data/site.db to .txt files')
+	p.add_argument('folder')
+	p = commands.add_parser('serve', help='keep a site loaded and build it on requests over a Unix socket')
+	p.add_argument('--socket', help=f'socket path (default data/{BUILD_SOCKET})')
+	p.add_argument('folder')
+	p = commands.add_parser('client', help='send a request to a build server')
+	p.add_argument('--socket', help=f'socket path (default data/{BUILD_SOCKET})')
+	p.add_argument('folder')
+	p.add_argument('request', choices=['render', 'rebuild', 'status', 'stop'])
+	p.add_argument('page', nargs='?')
+	args = parser.parse_args(args)
+	match args.command:
+		case 'build':
+			return 0 if build_sites(args.folders, args.jobs) else 1
+		case 'rollback':
+			try:
+				print(f'Current release is {rollback(Site(args.folder), args.release)}')
+			except ValueError as err:
+				print(err, file=sys.stderr)
+				return 1
+			return 0
+		case 'mdcompare':
+			return 0 if compare_markdown(args.folder, args.engines.split(','), args.diffs) else 1
+		case 'bundle':
+			return 0 if bundle_site(args.folder, args.output, args.since) else 1
+		case 'import':
+			return 0 if import_pages(args.folder, args.prune, args.force) else 1
+		case 'export':
+			return 0 if export_pages(args.folder) else 1
+		case 'serve':
+			return 0 if serve_site(args.folder, args.socket) else 1
+		case 'client':
+			try:
+				return 0 if build_client(args.folder, args.request, args.page, args.socket) else 1
+			except OSError as err:
+				print(f'No build server: {err}', file=sys.stderr)
+				return 1
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		sys.exit(command_line(sys.argv[1:]))
+
+	gui = True
+	root = Tk()
+	root.title("StaticSiteBuilder")
+	root.protocol("WM_DELETE_WINDOW", on_closing)
+	root.columnconfigure(1, weight=1)
+	root.rowconfigure(0, weight=1)
+
+	leftframe = ttk.Frame(root, width=36)
+	leftframe.columnconfigure(1, weight=1)
+	leftframe.rowconfigure(2, weight=1)
+	leftframe.grid(column=0, row=0, sticky="nsw")
+
+	rightframe = ttk.Frame(root)
+	rightframe.columnconfigure(4, weight=1)
+	rightframe.rowconfigure(1, weight=1)
+	rightframe.grid(column=1, row=0, sticky="nsew")
+
+	ttk.Button(leftframe, text="Open Site", command=open_site).grid(column=0, row=0)
+	ttk.Button(leftframe, text="New Site", command=new_site).grid(column=1, row=0)
+	ttk.Label(leftframe, text="Pages").grid(column=0, row=1)
+	page_filter = StringVar()
+	page_filter.trace_add('write', populate_pages_listbox)
+	ttk.Entry(leftframe, textvariable=page_filter).grid(column=1, columnspan=3, row=1, sticky="ew")
+	pagelistbox = Listbox(leftframe, width=30, activestyle='none')
+	pagelistbox.bind('<Double-Button>', select_page)
+	pagelistbox.grid(column=0, row=2, columnspan=4, sticky="nsew")
+	ttk.Button(leftframe, text="Select Page", command=select_page).grid(column=0, row=3)
+	ttk.Button(leftframe, text="New Page", command=new_page).grid(column=1, row=3)
+
+	content_label = ttk.Label(rightframe, text="Content")
+	content_label.grid(column=0, row=0, columnspan=5)
+	pagetext = scrolledtext.ScrolledText(rightframe, undo=True, wrap=WORD)
+	pagetext.bind("<<Modified>>", on_changed)
+	pagetext.grid(column=0, row=1, columnspan=5, sticky='nsew')
+	ttk.Button(rightframe, text="Save Page", command=save_current_page).grid(column=0, row=2)
+	ttk.Button(rightframe, text="Rebuild All", command=rebuild_all).grid(column=1, row=2)
+	ttk.Button(rightframe, text="Sync", command=sync_site).grid(column=2, row=2)
+	ttk.Button(rightframe, text="Check Links", command=check_links).grid(column=3, row=2)
+	status_label = ttk.Label(rightframe, text='')
+	status_label.grid(column=4, row=2, sticky='w')
+
+	if output_display:
+		xtext = scrolledtext.ScrolledText(rightframe, undo=True, wrap=WORD)
+		xtext.grid(column=5, row=0, columnspan=1, rowspan=3, sticky='nsew')
+
+
+	for child in leftframe.winfo_children(): 
+	    child.grid_configure(padx=5, pady=5)
+	for child in rightframe.winfo_children(): 
+	    child.grid_configure(padx=5, pady=5)
+
+	w = root.winfo_screenwidth()
+	h = root.winfo_screenheight()
+	root.geometry(str(int(.5 * w)) + 'x' + str(int(.6 * h)) + "+100+100")
+	root.minsize(1000, 500) # width was 600
+	root.bind('<Control-s>', control_s)
+
+	root.mainloop()
@@ -0,0 +1,24 @@
+# Shared fixtures for the tests.
+import importlib
+import os
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope='module')
+def build(tmp_path_factory):
+	# build.py reads .macros.txt from the current folder when it's imported
+	folder = tmp_path_factory.mktemp('start')
+	(folder / '.macros.txt').write_text('\n')
+	cwd = os.getcwd()
+	sys.path.insert(0, REPO)
+	os.chdir(folder)
+	try:
+		module = importlib.import_module('build')
+	finally:
+		os.chdir(cwd)
+		sys.path.remove(REPO)
+	module.UPLOAD_RETRY_DELAY = 0
+	return module
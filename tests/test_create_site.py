@@ -0,0 +1,14 @@
+# Tests for creating a new site in an empty folder.
+import os
+
+def test_new_site_in_empty_folder_builds(build, tmp_path):
+	site = build.Site(str(tmp_path))
+	build.create_site(site)
+	for name in ['header.html', 'footer.html', 'menu.html', 'site.css', 'index.html']:
+		assert os.path.isfile(tmp_path / name)
+	assert 'Home Page' in (tmp_path / 'index.html').read_text()
+	site = build.Site(str(tmp_path))
+	build.load_site(site)
+	build.build_site(site)
+	build.close_store(site)
+	assert site.num_successful == site.num_attempted
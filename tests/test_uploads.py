@@ -0,0 +1,133 @@
+# Tests for the background upload queue, using an in-process stand-in for the SFTP server.
+import os
+import threading
+
+class FakeServer:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.files = {} # path -> number of times uploaded
+		self.fail = {} # path -> number of uploads that fail before one succeeds
+		self.broken = set() # paths that can never be uploaded
+		self.gate = {} # path -> Event that put() waits for
+		self.remote = {} # path -> where it was put on the server
+		self.folders = [] # folders made, in order
+		self.connections = 0
+		self.closed = 0
+
+	def connect(self):
+		with self.lock:
+			self.connections += 1
+		return FakeConnection(self)
+
+class FakeConnection:
+	def __init__(self, server):
+		self.server = server
+		self.open = True
+
+	def put(self, path, remotepath=None):
+		server = self.server
+		assert self.open
+		if path in server.gate:
+			server.gate[path].wait(5)
+		with server.lock:
+			if path in server.broken:
+				raise IOError(f'cannot write {path}')
+			if server.fail.get(path, 0) > 0:
+				server.fail[path] -= 1
+				raise IOError('connection reset')
+			server.files[path] = server.files.get(path, 0) + 1
+			server.remote[path] = remotepath or os.path.basename(path)
+
+	def makedirs(self, folder):
+		with self.server.lock:
+			self.server.folders.append(folder)
+
+	def close(self):
+		self.open = False
+		with self.server.lock:
+			self.server.closed += 1
+
+def test_uploads_everything_over_pooled_connections(build):
+	server = FakeServer()
+	q = build.UploadQueue(server.connect, workers=3)
+	q.check()
+	paths = [f'page{i}.html' for i in range(30)]
+	for path in paths:
+		q.put(path)
+	results = q.wait()
+	q.close()
+	assert results == {path: None for path in paths}
+	assert set(server.files) == set(paths)
+	assert server.connections <= 4 # one for check() plus at most one per worker
+	assert server.closed == server.connections
+
+def test_transient_failure_is_retried_on_a_new_connection(build):
+	server = FakeServer()
+	server.fail['a.html'] = 2
+	q = build.UploadQueue(server.connect, workers=1, retries=3)
+	q.put('a.html')
+	results = q.wait()
+	q.close()
+	assert results == {'a.html': None}
+	assert server.files['a.html'] == 1
+	assert server.connections == 3
+
+def test_permanent_failure_is_reported_after_retries(build):
+	server = FakeServer()
+	server.broken.add('bad.html')
+	q = build.UploadQueue(server.connect, workers=2, retries=2)
+	q.put('bad.html')
+	q.put('good.html')
+	results = q.wait()
+	q.close()
+	assert results['good.html'] is None
+	assert isinstance(results['bad.html'], IOError)
+	assert 'bad.html' not in server.files
+	assert server.connections >= 3 # the bad file was tried once plus twice more
+
+def test_file_queued_twice_is_uploaded_once(build):
+	server = FakeServer()
+	server.gate['first.html'] = threading.Event()
+	q = build.UploadQueue(server.connect, workers=1)
+	q.put('first.html') # the only worker waits on this one
+	for i in range(3):
+		q.put('menu.html')
+	server.gate['first.html'].set()
+	results = q.wait()
+	q.close()
+	assert set(results) == {'first.html', 'menu.html'}
+	assert server.files['menu.html'] == 1
+
+def test_finish_uploads_reports_results(build, tmp_path):
+	server = FakeServer()
+	site = build.Site(str(tmp_path))
+	site.sftp = build.UploadQueue(server.connect, workers=2, retries=1)
+	build.begin_build(site)
+	ok = os.path.join(site.folder, 'ok.html')
+	asset = os.path.join(site.folder, 'img.png')
+	bad = os.path.join(site.folder, 'bad.html')
+	server.broken.add(bad)
+	site.asset_manifest['img.png'] = ['1234', 4, 0.0, '']
+	site.uploaded_assets[asset] = ('img.png', '1234')
+	for path in (ok, asset, bad):
+		build.sftp_put(site, path)
+	build.finish_uploads(site)
+	site.sftp.close()
+	assert site.num_attempted == 3
+	assert site.num_successful == 2
+	assert 'Uploaded ok.html' in site.build_report
+	assert 'Uploaded img.png' in site.build_report
+	assert any(s.startswith('Upload FAILED bad.html') for s in site.build_report)
+	assert site.asset_manifest['img.png'][3] == '1234'
+
+def test_files_in_subfolders_keep_their_path(build, tmp_path):
+	server = FakeServer()
+	site = build.Site(str(tmp_path))
+	site.sftp = build.UploadQueue(server.connect, workers=1)
+	paths = [site.out_path(rel) for rel in ('index.html', os.path.join('img', 'a.png'), os.path.join('img', 'b.png'))]
+	for path in paths:
+		build.sftp_put(site, path)
+	site.sftp.wait()
+	site.sftp.close()
+	assert [server.remote[path] for path in paths] == ['index.html', 'img/a.png', 'img/b.png']
+	assert server.folders == ['img']